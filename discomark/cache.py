@@ -0,0 +1,174 @@
+"""Per-ortholog cache of step outputs.
+
+This module implements a cache of the files (and python objects) produced
+for single orthologs by the pipeline steps, keyed by a hash of everything
+the output depends on (input files, tool settings and tool version). Steps
+reuse the cached output for orthologs whose inputs did not change. The
+least recently used entries are removed when the cache exceeds its size.
+
+"""
+
+from __future__ import division, print_function
+import hashlib
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
+
+_tool_versions = {}
+_source_versions = {}
+
+def tool_version(cline):
+    """Return the version string printed by cline (e.g. ['mafft', '--version'])."""
+    key = tuple(cline)
+    if key not in _tool_versions:
+        try:
+            proc = subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            _tool_versions[key] = proc.communicate()[0].decode('utf-8', 'replace').strip()
+        except OSError:
+            _tool_versions[key] = ''
+    return _tool_versions[key]
+
+def source_version(path):
+    """Return a checksum of the python sources in path (for in-process tools)."""
+    if path not in _source_versions:
+        sha = hashlib.sha1()
+        for fn in sorted(os.listdir(path)):
+            if fn.endswith('.py'):
+                with open(os.path.join(path, fn), 'rb') as f:
+                    sha.update(f.read())
+        _source_versions[path] = sha.hexdigest()
+    return _source_versions[path]
+
+
+class StepCache(object):
+    """Directory of step outputs, one folder per key.
+
+    Keys are built from strings and files with key(). Entries hold copies of
+    output files (fetch/store) or a pickled object (load/save). Entries are
+    written to a temporary folder and renamed, so that readers never see
+    partial entries. Entries may be added from several threads.
+    """
+
+    def __init__(self, cache_dir, max_size=1024**3):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.size = sum([size for (_, _, size) in self.entries()])
+
+    def __repr__(self):
+        return "<StepCache(dir='%s', size=%d)>" % (self.cache_dir, self.size)
+
+    @staticmethod
+    def key(*parts):
+        """Hash of the given strings and file contents (parts of the form ('file', path))."""
+        sha = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, tuple) and len(part) == 2 and part[0] == 'file':
+                with open(part[1], 'rb') as f:
+                    data = f.read()
+            else:
+                data = str(part).encode('utf-8')
+            sha.update(('%d:' % len(data)).encode('ascii'))
+            sha.update(data)
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def entries(self):
+        """Yield (path, last use, size) of all entries."""
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if key.startswith('.'): # entry being written
+                    continue
+                path = os.path.join(prefix_dir, key)
+                try:
+                    size = sum([os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)])
+                    yield (path, os.path.getmtime(path), size)
+                except OSError: # removed concurrently
+                    continue
+
+    def fetch(self, key, out_fns):
+        """Copy the cached files to out_fns, return False if not cached."""
+        path = self._path(key)
+        cached_fns = [os.path.join(path, str(i)) for i in range(len(out_fns))]
+        if not all([os.path.isfile(fn) for fn in cached_fns]):
+            return False
+        try:
+            for cached_fn, out_fn in zip(cached_fns, out_fns):
+                shutil.copyfile(cached_fn, out_fn)
+            os.utime(path, None) # mark as recently used
+        except (IOError, OSError): # entry evicted concurrently
+            for out_fn in out_fns:
+                if os.path.isfile(out_fn):
+                    os.remove(out_fn)
+            return False
+        return True
+
+    def store(self, key, fns):
+        self._add(key, lambda tmp_dir: [shutil.copyfile(fn, os.path.join(tmp_dir, str(i))) for i, fn in enumerate(fns)])
+
+    def load(self, key):
+        """Return the cached object, or None if not cached."""
+        fn = os.path.join(self._path(key), 'pickle')
+        if not os.path.isfile(fn):
+            return None
+        try:
+            with open(fn, 'rb') as f:
+                obj = pickle.load(f)
+            os.utime(self._path(key), None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError): # evicted concurrently or truncated
+            return None
+        return obj
+
+    def save(self, key, obj):
+        def dump(tmp_dir):
+            with open(os.path.join(tmp_dir, 'pickle'), 'wb') as f:
+                pickle.dump(obj, f, 2)
+        self._add(key, dump)
+
+    def _add(self, key, write):
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        prefix_dir = os.path.dirname(path)
+        if not os.path.isdir(prefix_dir):
+            try:
+                os.makedirs(prefix_dir)
+            except OSError:
+                if not os.path.isdir(prefix_dir): # not created concurrently
+                    raise
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=prefix_dir)
+        try:
+            write(tmp_dir)
+            size = sum([os.path.getsize(os.path.join(tmp_dir, fn)) for fn in os.listdir(tmp_dir)])
+            os.rename(tmp_dir, path)
+            with self._lock:
+                self.size += size
+        except OSError:
+            if not os.path.isdir(path): # not added concurrently
+                raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is at 90% of its size limit."""
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda x: x[1])
+            self.size = sum([size for (_, _, size) in entries])
+            for path, _, size in entries:
+                if self.size <= 0.9 * self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                self.size -= size
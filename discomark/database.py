@@ -1,10 +1,12 @@
 from __future__ import division, print_function
 from discomark.models import *
-from sqlalchemy import create_engine, desc, distinct, func, bindparam
+from discomark import utils
+from sqlalchemy import create_engine, desc, distinct, event, func, bindparam, inspect
 from sqlalchemy.orm import sessionmaker
 import os, re, sys
+from collections import OrderedDict
+from itertools import groupby
 from glob import glob
-from Bio import Alphabet
 from Bio import SeqIO
 from Bio.Blast import NCBIXML
 
@@ -23,13 +25,54 @@ class DnaSeq:
     def __hash__(self):
         return hash((self.id, self.dna))
 
+# letters of Biopython's Gapped(IUPAC.ambiguous_dna) alphabet
+GAPPED_IUPAC_DNA = b'GATCRYWSMKHBVDN-'
+
+def is_dna(seq):
+    # byte-level alphabet check (upper-cased sequence string)
+    try:
+        return len(seq.upper().encode('ascii').translate(None, GAPPED_IUPAC_DNA)) == 0
+    except UnicodeError:
+        return False
+
+# parse and validate the FASTA files of a species folder
+# (returns a list of (ortholog id, file path, [(fasta id, residues), ...]);
+# runs in worker processes, so only plain tuples are returned)
+def parse_species_dir(sp_dir):
+    sp_files = glob(os.path.join(sp_dir, '*.fa')) + glob(os.path.join(sp_dir, '*.fasta'))
+    result = []
+
+    # loop through FASTA files
+    for fn in sp_files:
+        # read sequences
+        recs = [(r.id, str(r.seq)) for r in SeqIO.parse(fn, 'fasta')]
+        # make sure sequences are DNA
+        if not all(is_dna(dna) for _, dna in recs):
+            continue
+
+        #oid = re.findall("^\d+", os.path.split(fn)[1])[0]
+        oid = os.path.split(fn)[1].split('.')[0]
+
+        # make sure sequences are unique
+        sequences = set()
+        seqs = []
+        for seq_id, dna in recs:
+            seq = DnaSeq(seq_id, dna)
+            if seq in sequences:
+                continue
+            sequences.add(seq)
+            seqs.append((seq_id, dna))
+        result.append((oid, fn, seqs))
+
+    return result
+
 ###############################
 # DB access abstraction layer #
 ###############################
 
 class DataBroker():
     """ This class maintains the db session and handles data access. """
-    def __init__(self, project_name):
+    def __init__(self, project_name, tuned=True):
         # choose whether to use an in-memory db or create a db file
         if project_name:
             self.conn_str = 'sqlite:///%s/markers.db' % (project_name)
@@ -39,10 +82,37 @@ class DataBroker():
 
         # connection to database
         self.engine = create_engine(self.conn_str, echo=False)
+        if tuned:
+            event.listen(self.engine, 'connect', self.set_sqlite_pragmas)
+            self.create_indexes()
         # create a database session
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
 
+    # speed up pipeline runs: write-ahead log instead of a rollback journal,
+    # sync to disk only at checkpoints, 64 MB page cache
+    @staticmethod
+    def set_sqlite_pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-65536')
+        cursor.close()
+
+    # add tables and indexes missing in databases created by older versions
+    # (create_all() skips tables that already exist)
+    def create_indexes(self):
+        inspector = inspect(self.engine)
+        tables = inspector.get_table_names()
+        for tab in Base.metadata.sorted_tables:
+            if tables and tab.name not in tables:
+                tab.create(self.engine)
+            elif tab.name in tables:
+                existing = set(ix['name'] for ix in inspector.get_indexes(tab.name))
+                for idx in tab.indexes:
+                    if idx.name not in existing:
+                        idx.create(self.engine)
+
     def get_session(self):
         return self.session
 
@@ -55,35 +125,58 @@ class DataBroker():
         orthologs = self.session.query(Ortholog).all()
         return orthologs
 
+    # per-ortholog checkpoints of a pipeline step
+    # (returns {ortholog id: (input key, [output file names], output checksum)})
+    def get_checkpoints(self, step):
+        rows = self.session.query(Checkpoint.id_ortholog, Checkpoint.key, Checkpoint.files, Checkpoint.checksum) \
+                           .filter(Checkpoint.step == step) \
+                           .order_by(Checkpoint.id)
+        return dict((o_id, (key, files.split(';') if files else [], checksum)) for o_id, key, files, checksum in rows)
+
+    # record a completed ortholog
+    # (committed on a separate connection, so that loaded records are not expired)
+    def add_checkpoint(self, step, o_id, key, files, checksum):
+        tab = Checkpoint.__table__
+        with self.engine.begin() as conn:
+            conn.execute(tab.delete().where((tab.c.step == step) & (tab.c.id_ortholog == o_id)))
+            conn.execute(tab.insert(), [{'step': step, 'id_ortholog': o_id, 'key': key,
+                                         'files': ';'.join(files), 'checksum': checksum}])
+
     # get best (max len) Blast hits from database
-    # (result is indexed by reference to facilitate reference fasta processing)
-    def get_best_hits(self):
-        # retrieve maximal length of Blast hit for each ortholog
-        ortho_hits = self.session.query(Ortholog.id, Mapping.refseq, func.max(Mapping.length)).join(Ortholog.sequences).join(Sequence.mappings).group_by(Ortholog).all()
+    # (result is indexed by reference to facilitate reference fasta processing,
+    # optionally restricted to the given ortholog ids)
+    def get_best_hits(self, orthologs=None):
+        # retrieve all Blast hits in one scan, grouped by ortholog
+        hits = (
+            self.session.query(
+                Ortholog.id,
+                Sequence.fasta_id,
+                Mapping.refseq,
+                Mapping.ref_start,
+                Mapping.ref_end,
+                Mapping.length,
+                Mapping.strand
+            )
+            .join(Ortholog.sequences)
+            .join(Sequence.mappings)
+            .order_by(Ortholog.id, Sequence.id, Mapping.id)
+        )
+        if orthologs is not None:
+            hits = hits.filter(Ortholog.id.in_(orthologs))
         ref2ortho = {}
-        # for each ortholog's best hit, get
+        # for each ortholog's best (max len) hit, get
         #  - orientation of each sequence hit
         #  - reference sequence range
-        for o_id, ref_id, max_len in ortho_hits:
-            hits = (
-                self.session.query(
-                    Ortholog.id,
-                    Sequence.fasta_id,
-                    Mapping.ref_start,
-                    Mapping.ref_end,
-                    Mapping.strand
-                )
-                .join(Ortholog.sequences)
-                .join(Sequence.mappings)
-                .filter(Ortholog.id==o_id, Mapping.refseq==ref_id)
-                .all()
-            )
-            start = min([x[2] for x in hits])
-            end   = max([x[3] for x in hits])
+        for o_id, o_hits in groupby(hits, key=lambda x: x[0]):
+            o_hits = list(o_hits)
+            ref_id = max(o_hits, key=lambda x: x[5])[2]
+            ref_hits = [x for x in o_hits if x[2] == ref_id]
+            start = min([x[3] for x in ref_hits])
+            end   = max([x[4] for x in ref_hits])
 
             if ref_id not in ref2ortho:
                 ref2ortho[ref_id] = []
-            ref2ortho[ref_id].append({'ortholog':o_id, 'range': (start, end), 'seqs': {x[1]: x[4] for x in hits}})
+            ref2ortho[ref_id].append({'ortholog':o_id, 'range': (start, end), 'seqs': {x[1]: x[6] for x in ref_hits}})
 
         return ref2ortho
 
@@ -126,6 +219,15 @@ class DataBroker():
             #print("\tWarning: file '%s' is missing! Orthologs will not be functionally annotated." % anno_fn)
             return False
 
+        # Function and Ortholog rows are looked up in dicts instead of the
+        # database; new rows and all associations are written in bulk
+        functions = dict((x.shortcode, x.id) for x in session.query(Function.id, Function.shortcode))
+        ortho_ids = set(x[0] for x in session.query(Ortholog.id))
+        fun_id = (session.query(func.max(Function.id)).scalar() or 0) + 1
+        new_funcs = OrderedDict()
+        new_orthos = []
+        descriptions = {}
+        fun_orthos = OrderedDict()
         for l in open(anno_fn):
             line = l.rstrip()
             cols = l.strip().split('\t')
@@ -143,18 +245,40 @@ class DataBroker():
             #    session.add(db_cat)
             #else:
 
-            db_fun = self.get_or_create(Function, shortcode=scode)
+            if scode not in functions:
+                functions[scode] = fun_id
+                new_funcs[fun_id] = {'id': fun_id, 'shortcode': scode, 'description': None}
+                fun_id += 1
+            f_id = functions[scode]
             if len(desc) > 0:
-                db_fun.description = desc
+                descriptions[f_id] = desc
             #db_fun.category = db_cat
 
-            db_ortho = self.get_or_create(Ortholog, id=int(cols[0]))
-            db_ortho.functions.append(db_fun)
+            o_id = str(int(cols[0]))
+            if o_id not in ortho_ids:
+                ortho_ids.add(o_id)
+                new_orthos.append({'id': o_id})
+            fun_orthos[(f_id, o_id)] = True
+
+        for f_id, desc in descriptions.items():
+            if f_id in new_funcs:
+                new_funcs[f_id]['description'] = desc
+        old_descs = [{'f_id': f_id, 'desc': desc} for f_id, desc in descriptions.items() if f_id not in new_funcs]
+
+        if new_funcs:
+            session.execute(Function.__table__.insert(), list(new_funcs.values()))
+        if old_descs:
+            fun_tab = Function.__table__
+            session.execute(fun_tab.update().where(fun_tab.c.id == bindparam('f_id')).values(description=bindparam('desc')), old_descs)
+        if new_orthos:
+            session.execute(Ortholog.__table__.insert(), new_orthos)
+        if fun_orthos:
+            session.execute(fun_orto.insert(), [{'id_function': f_id, 'id_ortholog': o_id} for (f_id, o_id) in fun_orthos])
         session.commit()
 
     # loading input data
     # =====================
-    def create_db_from_input(self, input_dir, log_fh=sys.stderr):
+    def create_db_from_input(self, input_dir, log_fh=sys.stderr, num_procs=1):
         session = self.session
 
         print("\nLoading data from directory '%s' ..." % input_dir, file=log_fh)
@@ -162,44 +286,45 @@ class DataBroker():
         species = next(os.walk(input_dir))[1]
         print("\nFound %d species:\n\t%s\n" % (len(species), '\n\t'.join(species)), file=log_fh)
 
-        # traverse species folders
-        for sp_name in species:
-            db_species = Species(name=sp_name)
-            session.add(db_species)
-
-            sp_dir = os.path.join(input_dir, sp_name)
-            sp_files = glob(os.path.join(sp_dir, '*.fa')) + glob(os.path.join(sp_dir, '*.fasta'))
-
-            # loop through FASTA files
-            for fn in sp_files:
-                # read sequences
-                recs = list(SeqIO.parse(fn, 'fasta', alphabet=Alphabet.Gapped(Alphabet.IUPAC.ambiguous_dna)))
-                seqs_ok = True
-                # make sure sequences are DNA
-                for r in recs:
-                    if not Alphabet._verify_alphabet(r.seq.upper()):
-                        seqs_ok = False
-                        break
-                if not seqs_ok:
-                    continue
-
-                #oid = re.findall("^\d+", os.path.split(fn)[1])[0]
-                oid = os.path.split(fn)[1].split('.')[0]
-
-                db_ortho = self.get_or_create(Ortholog, id=str(oid))
-                db_file = File(path=fn)
-                db_file.ortholog = db_ortho
-                session.add(db_file)
-
-                # make sure sequences are unique
-                sequences = set([DnaSeq(r.id, str(r.seq)) for r in SeqIO.parse(open(fn, 'rt'), 'fasta')])
-                for seq in sequences:
-                    db_seq = Sequence(fasta_id=seq.id, description='', residues=str(seq.dna.upper()))
-                    db_seq.species = db_species
-                    db_seq.ortholog = db_ortho
-                    session.add(db_seq)
-                    session.flush()
-                    db_seq.description = "id=%d,id_species=%d" % (db_seq.id, db_species.id)
+        # row ids are assigned here rather than by the database, so that the
+        # sequence descriptions can be written in the same bulk insert
+        def next_id(model):
+            return (session.query(func.max(model.id)).scalar() or 0) + 1
+        species_id = next_id(Species)
+        file_id = next_id(File)
+        seq_id = next_id(Sequence)
+        # orthologs may already exist (from annotations)
+        ortho_ids = set(x[0] for x in session.query(Ortholog.id))
+
+        # species folders are parsed by worker processes (largest first),
+        # rows are inserted here in folder order
+        jobs = [(os.path.join(input_dir, sp_name),) for sp_name in species]
+        costs = [sum(os.path.getsize(os.path.join(d, fn)) for fn in os.listdir(d)) for (d,) in jobs]
+        results = utils.run_jobs(parse_species_dir, jobs, num_procs, costs, processes=True)
+        for sp_name, sp_files in zip(species, results):
+            ortho_rows = []
+            file_rows = []
+            seq_rows = []
+
+            for oid, fn, seqs in sp_files:
+                if oid not in ortho_ids:
+                    ortho_ids.add(oid)
+                    ortho_rows.append({'id': oid})
+                file_rows.append({'id': file_id, 'id_ortholog': oid, 'path': fn})
+                file_id += 1
+
+                for fasta_id, dna in seqs:
+                    seq_rows.append({'id': seq_id, 'id_species': species_id, 'id_ortholog': oid,
+                                     'fasta_id': fasta_id, 'residues': dna.upper(),
+                                     'description': "id=%d,id_species=%d" % (seq_id, species_id)})
+                    seq_id += 1
+
+            # insert this species' data
+            session.execute(Species.__table__.insert(), [{'id': species_id, 'name': sp_name}])
+            for tab, rows in ((Ortholog.__table__, ortho_rows), (File.__table__, file_rows), (Sequence.__table__, seq_rows)):
+                if rows:
+                    session.execute(tab.insert(), rows)
+            species_id += 1
 
         # save data to database
         session.commit()
@@ -207,7 +332,7 @@ class DataBroker():
 
     # loading BLAST hits
     # ======================
-    def load_blast_hits(self, blast_filename, add=False):
+    def load_blast_hits(self, blast_filename, add=False, batch_size=10000, per_ortholog=False):
         session = self.session
 
         # truncate existing table if not in 'add' mode
@@ -216,34 +341,54 @@ class DataBroker():
             session.execute(tab.delete())
             session.commit()
 
-        # find best reference hits in local alignments
-        f = open(blast_filename, 'rt')
-        row = f.readline().strip().split()
-        seq_id, ref_id, max_len, strand = (row[0], row[1], int(row[3]), row[12])
-        start = int(row[8]) if strand == 'plus' else int(row[9])
-        end   = int(row[9]) if strand == 'plus' else int(row[8])
-        # format: qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand
-        for line in f:
-            row = line.strip().split()
-            if seq_id == row[0]:
-                # extend reference position range if necessary
-                if ref_id == row[1]:
-                    reverse = (row[12] == 'minus')
-                    hit_start = int(row[8]) if not reverse else int(row[9])
-                    hit_end   = int(row[9]) if not reverse else int(row[8])
-                    start = min(start, hit_start)
-                    end   = max(end, hit_end)
-                    max_len = max(max_len, int(row[3]))
-                    strand = row[12]
-                continue
-            else:
-                mapping = Mapping(refseq=ref_id, ref_start=start, ref_end=end, length=max_len, strand=strand)
-                seq = session.query(Sequence).filter_by(fasta_id=seq_id).first()
-                mapping.sequence = seq
-                session.add(mapping)
-            seq_id, ref_id, max_len, strand = (row[0], row[1], int(row[3]), row[12])
-            start = int(row[8]) if strand == 'plus' else int(row[9])
-            end   = int(row[9]) if strand == 'plus' else int(row[8])
+        # map query ids to sequence ids
+        seq_ids = {}
+        if per_ortholog:
+            # queries are orthologs (one representative each), their hits apply
+            # to all sequences of the ortholog (aligned in the same direction)
+            for o_id, s_id in session.query(Ortholog.id, Sequence.id).join(Ortholog.sequences).order_by(Sequence.id):
+                seq_ids.setdefault(o_id, []).append(s_id)
+        else:
+            # FASTA ids (first sequence with that id)
+            for s_id, fasta_id in session.query(Sequence.id, Sequence.fasta_id).order_by(Sequence.id):
+                seq_ids.setdefault(fasta_id, [s_id])
+
+        # find best reference hits in local alignments:
+        # the first hit of a query determines the reference sequence, further
+        # hits on the same reference extend the position range
+        # (hits of a query don't have to be adjacent in the file)
+        hits = OrderedDict()
+        with open(blast_filename, 'rt') as f:
+            # format: qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand
+            for line in f:
+                row = line.split()
+                if len(row) == 0:
+                    continue
+                seq_id, ref_id, length, strand = (row[0], row[1], int(row[3]), row[12])
+                start = int(row[8]) if strand == 'plus' else int(row[9])
+                end   = int(row[9]) if strand == 'plus' else int(row[8])
+                hit = hits.get(seq_id)
+                if hit is None:
+                    hits[seq_id] = [ref_id, start, end, length, strand]
+                elif hit[0] == ref_id:
+                    # extend reference position range if necessary
+                    hit[1] = min(hit[1], start)
+                    hit[2] = max(hit[2], end)
+                    hit[3] = max(hit[3], length)
+                    hit[4] = strand
+
+        # insert mappings in batches
+        tab = Mapping.__table__
+        rows = []
+        for seq_id, (ref_id, start, end, length, strand) in hits.items():
+            for s_id in seq_ids.get(seq_id, [None]):
+                rows.append({'id_sequence': s_id, 'refseq': ref_id, 'ref_start': start,
+                             'ref_end': end, 'length': length, 'strand': strand})
+            if len(rows) >= batch_size:
+                session.execute(tab.insert(), rows)
+                rows = []
+        if rows:
+            session.execute(tab.insert(), rows)
 
         session.commit()
 
@@ -312,6 +457,7 @@ Avg\. #sequences in primer alignments: \S+ / \S+
     # set flag indicating if all Sequences of an Ortholog hit the same BLAST target
     def update_uniq_ref_flag(self):
         hit_counts = self.session.query(Ortholog.id, func.count(distinct(Mapping.refseq))) \
+                         .select_from(Ortholog) \
                          .outerjoin(Sequence) \
                          .join(Mapping) \
                          .group_by(Ortholog.id) \
@@ -0,0 +1,260 @@
+"""Random access to reference genome sequences.
+
+This module implements an index of a FASTA file in the format of samtools
+faidx (.fai), so that slices of large reference sequences can be read from
+a memory-mapped file without parsing and holding whole records, and a cache
+of the data derived from a genome (BLAST database, FASTA index) that is
+shared between runs and projects.
+
+"""
+
+from __future__ import division, print_function
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+class FastaIndex(object):
+    """Offset index of a FASTA file.
+
+    For each record, the index holds the sequence length, the file offset of
+    the first base, and the number of bases and bytes per line. The index is
+    read from '<fasta>.fai' if it is newer than the FASTA file, otherwise it
+    is built and written there. Records must have lines of equal length
+    (except the last one), otherwise a ValueError is raised.
+    """
+
+    def __init__(self, fasta_fn, index_fn=None):
+        self.fasta_fn = fasta_fn
+        self.index_fn = index_fn if index_fn else fasta_fn + '.fai'
+        if (os.path.exists(self.index_fn) and
+                os.path.getmtime(self.index_fn) > os.path.getmtime(fasta_fn)):
+            self.entries = self.read_index(self.index_fn)
+        else:
+            self.entries = self.build(fasta_fn)
+            try:
+                self.write_index(self.index_fn)
+            except (IOError, OSError):
+                pass # index is kept in memory only
+        self._fh = open(fasta_fn, 'rb')
+        self._mm = None
+        if os.path.getsize(fasta_fn) > 0:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return "<FastaIndex(fasta='%s', records=%d)>" % (self.fasta_fn, len(self.entries))
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def names(self):
+        return list(self.entries.keys())
+
+    @staticmethod
+    def build(fasta_fn):
+        entries = OrderedDict()
+        rec = None
+        pos = 0
+        with open(fasta_fn, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if rec:
+                        entries[rec[0]] = tuple(rec[1:5])
+                    name = line[1:].split(None, 1)
+                    name = name[0].decode('latin-1') if name else ''
+                    # name, length, offset, line bases, line width, last line seen
+                    rec = [name, 0, pos + len(line), 0, 0, False]
+                elif rec:
+                    n = len(line.rstrip(b'\r\n'))
+                    if n > 0 and rec[5]:
+                        raise ValueError("FASTA record '%s' in '%s' has lines of different length" % (rec[0], fasta_fn))
+                    if rec[3] == 0 and rec[1] == 0:
+                        rec[3], rec[4] = n, len(line)
+                    elif n != rec[3] or len(line) != rec[4]:
+                        if n > rec[3]:
+                            raise ValueError("FASTA record '%s' in '%s' has lines of different length" % (rec[0], fasta_fn))
+                        rec[5] = True
+                    rec[1] += n
+                pos += len(line)
+        if rec:
+            entries[rec[0]] = tuple(rec[1:5])
+        return entries
+
+    @staticmethod
+    def read_index(index_fn):
+        entries = OrderedDict()
+        with open(index_fn, 'rt') as f:
+            for line in f:
+                cols = line.rstrip('\r\n').split('\t')
+                if len(cols) >= 5:
+                    entries[cols[0]] = tuple(int(x) for x in cols[1:5])
+        return entries
+
+    def write_index(self, index_fn):
+        with open(index_fn, 'wt') as f:
+            for name, entry in self.entries.items():
+                f.write('%s\t%d\t%d\t%d\t%d\n' % ((name,) + entry))
+
+    def length(self, name):
+        return self.entries[name][0]
+
+    def description(self, name):
+        """Return the header line of a record (without '>')."""
+        offset = self.entries[name][1]
+        start = self._mm.rfind(b'\n', 0, max(0, offset-1)) + 1
+        return self._mm[start+1:offset].rstrip().decode('latin-1')
+
+    def fetch(self, name, start, end):
+        """Return bases [start, end) (0-based) of a record as a string."""
+        length, offset, line_bases, line_width = self.entries[name]
+        start = max(0, min(start, length))
+        end = max(start, min(end, length))
+        if end == start:
+            return ''
+        pos = lambda i: offset + (i // line_bases) * line_width + i % line_bases
+        return self._mm[pos(start):pos(end)].replace(b'\n', b'').replace(b'\r', b'').decode('latin-1')
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._fh.close()
+
+
+def checksum(fn, block_size=1<<20):
+    """Return the SHA-1 checksum of a file's content.
+
+    The checksum is stored in '<fn>.sha1' and reused while that file is
+    newer than fn.
+    """
+    sha_fn = fn + '.sha1'
+    if os.path.exists(sha_fn) and os.path.getmtime(sha_fn) > os.path.getmtime(fn):
+        with open(sha_fn, 'rt') as f:
+            return f.read().strip()
+    sha = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+    digest = sha.hexdigest()
+    try:
+        with open(sha_fn, 'wt') as f:
+            f.write(digest + '\n')
+    except (IOError, OSError):
+        pass
+    return digest
+
+
+class GenomeCache(object):
+    """Data derived from genome files, stored by genome checksum.
+
+    Each genome gets a folder '<cache_dir>/<sha1>' holding its BLAST database
+    ('blastdb/genome.*') and FASTA index ('genome.fasta.fai'), so these are
+    built once for all runs and projects using the same assembly. If max_size
+    is given, the least recently used genomes are removed when the cache
+    exceeds it (the genome in use is always kept).
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+
+    def __repr__(self):
+        return "<GenomeCache(dir='%s')>" % self.cache_dir
+
+    def entry(self, genome):
+        path = os.path.join(self.cache_dir, checksum(genome))
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path): # not created concurrently
+                    raise
+        os.utime(path, None) # mark as recently used
+        return path
+
+    def entries(self):
+        """Return (path, last use, size) of all genomes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(path):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(d, fn)) for d, _, fns in os.walk(path) for fn in fns])
+                entries.append((path, os.path.getmtime(path), size))
+            except OSError: # removed concurrently
+                continue
+        return entries
+
+    def evict(self, keep):
+        """Remove least recently used genomes (except keep) until the cache fits its size limit."""
+        if not self.max_size:
+            return
+        entries = sorted(self.entries(), key=lambda x: x[1])
+        size = sum([s for (_, _, s) in entries])
+        for path, _, s in entries:
+            if size <= self.max_size:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                size -= s
+
+    def blast_db(self, genome, log_fh=sys.stderr):
+        """Return the path of the BLAST database for genome (built if missing)."""
+        path = self.entry(genome)
+        db_dir = os.path.join(path, 'blastdb')
+        db = os.path.join(db_dir, 'genome')
+        if os.path.isdir(db_dir):
+            print("\tusing cached BLAST database: %s\n" % db, file=log_fh)
+            return db
+
+        # build in a temporary folder, which is moved into place when complete
+        tmp_dir = tempfile.mkdtemp(prefix='blastdb.', dir=os.path.dirname(db_dir))
+        try:
+            cline = ['makeblastdb', '-in', genome, '-dbtype', 'nucl', '-out', os.path.join(tmp_dir, 'genome')]
+            print("\t%s\n" % ' '.join(cline), file=log_fh)
+            log_fh.flush()
+            if subprocess.call(cline, stdout=log_fh, stderr=log_fh) != 0:
+                raise RuntimeError("makeblastdb failed for '%s'" % genome)
+            try:
+                os.rename(tmp_dir, db_dir)
+            except OSError:
+                if not os.path.isdir(db_dir): # not built concurrently
+                    raise
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        self.evict(path)
+        return db
+
+    def fasta_index(self, genome):
+        """Return a FastaIndex of genome, using the cached index if present."""
+        path = self.entry(genome)
+        cached_fn = os.path.join(path, 'genome.fasta.fai')
+        index_fn = genome + '.fai'
+        if os.path.exists(cached_fn) and not (os.path.exists(index_fn) and
+                                              os.path.getmtime(index_fn) > os.path.getmtime(genome)):
+            shutil.copyfile(cached_fn, index_fn)
+        fai = FastaIndex(genome)
+        if not os.path.exists(cached_fn):
+            fai.write_index(cached_fn)
+            self.evict(path)
+        return fai
+
+
+def open_cache(config):
+    """Return the GenomeCache configured in the [Data] section, or None if there is none."""
+    if not config.has_option('Data', 'genome_cache_dir'):
+        return None
+    max_size = config.getint('Data', 'genome_cache_size') if config.has_option('Data', 'genome_cache_size') else 10240
+    return GenomeCache(config.get('Data', 'genome_cache_dir'), max_size * 1024**2)
@@ -0,0 +1,56 @@
+"""Per-ortholog checkpoints for resuming a pipeline step.
+
+When a step has completed an ortholog, its journal records a key of the
+ortholog's inputs (input files, settings and tool version, as used for the
+step cache) together with the names and checksum of the output files in the
+project database. When the step is run again (e.g. after a crash, using
+'--step N'), orthologs with unchanged inputs and intact output files are
+skipped.
+
+"""
+
+from __future__ import division, print_function
+import os
+from discomark.cache import StepCache
+
+
+class StepJournal(object):
+    """Checkpoints of the orthologs completed in one step.
+
+    Output files are given as paths in out_dir and recorded by name.
+    """
+
+    def __init__(self, model, step, out_dir):
+        self.model = model
+        self.step = step
+        self.out_dir = out_dir
+        self.entries = model.get_checkpoints(step)
+        self.skipped = 0
+
+    def __repr__(self):
+        return "<StepJournal(step=%d, entries=%d)>" % (self.step, len(self.entries))
+
+    @staticmethod
+    def checksum(fns):
+        return StepCache.key(*[('file', fn) for fn in fns])
+
+    def outputs(self, o_id):
+        """Return the recorded output files of an ortholog."""
+        return [os.path.join(self.out_dir, fn) for fn in self.entries[o_id][1]]
+
+    def done(self, o_id, key):
+        """Check if an ortholog was completed with the same inputs and its outputs are intact."""
+        entry = self.entries.get(o_id)
+        if entry is None or entry[0] != key:
+            return False
+        fns = self.outputs(o_id)
+        if not all([os.path.isfile(fn) for fn in fns]) or self.checksum(fns) != entry[2]:
+            return False
+        self.skipped += 1
+        return True
+
+    def record(self, o_id, key, fns):
+        names = [os.path.basename(fn) for fn in fns]
+        checksum = self.checksum(fns)
+        self.model.add_checkpoint(self.step, o_id, key, names, checksum)
+        self.entries[o_id] = (key, names, checksum)
@@ -24,7 +24,7 @@ class Category(Base):
 # many-to-many relationship between Function and Ortholog
 fun_orto = Table('function_ortholog', Base.metadata,
                  Column('id_function', Integer, ForeignKey('functions.id')),
-                 Column('id_ortholog', Integer, ForeignKey('orthologs.id')))
+                 Column('id_ortholog', String, ForeignKey('orthologs.id'), index=True))
 
 class Function(Base):
     """ Functional used in ortholog annotations. """
@@ -76,7 +76,7 @@ class OrthologAnnotation(Base):
     __tablename__ = 'ortholog_annotations'
 
     id          = Column(Integer, primary_key=True)
-    id_ortholog = Column(Integer, ForeignKey('orthologs.id'))
+    id_ortholog = Column(String, ForeignKey('orthologs.id'), index=True)
     funcode     = Column(String)
 
 class Sequence(Base):
@@ -85,8 +85,8 @@ class Sequence(Base):
 
     id          = Column(Integer, primary_key=True)
     id_species  = Column(Integer, ForeignKey('species.id'))
-    id_ortholog = Column(Integer, ForeignKey('orthologs.id'))
-    fasta_id    = Column(String)
+    id_ortholog = Column(String, ForeignKey('orthologs.id'), index=True)
+    fasta_id    = Column(String, index=True)
     description = Column(String)
     residues    = Column(Text)
     length      = Column(Integer)
@@ -100,7 +100,7 @@ class File(Base):
     __tablename__ = 'files'
 
     id          = Column(Integer, primary_key=True)
-    id_ortholog = Column(Integer, ForeignKey('orthologs.id'))
+    id_ortholog = Column(String, ForeignKey('orthologs.id'))
     path        = Column(String)
 
     def __repr__(self):
@@ -112,8 +112,8 @@ class Mapping(Base):
     __tablename__ = 'mappings'
 
     id          = Column(Integer, primary_key=True)
-    id_sequence = Column(Integer, ForeignKey('sequences.id'))
-    refseq      = Column(String)
+    id_sequence = Column(Integer, ForeignKey('sequences.id'), index=True)
+    refseq      = Column(String, index=True)
     ref_start   = Column(Integer)
     ref_end     = Column(Integer)
     length      = Column(Integer)
@@ -123,6 +123,20 @@ class Mapping(Base):
     def __repr__(self):
         return "<Mapping(seq='%s', ref='%s', len=%d, strand='%s')>" % (self.sequence.fasta_id, self.refseq, self.length, self.strand)
 
+class Checkpoint(Base):
+    """ Checkpoints record the orthologs completed in a pipeline step. """
+    __tablename__ = 'checkpoints'
+
+    id          = Column(Integer, primary_key=True)
+    step        = Column(Integer, index=True)
+    id_ortholog = Column(String, ForeignKey('orthologs.id'))
+    key         = Column(String) # hash of input files, settings and tool version
+    files       = Column(String) # names of output files (separated by ';')
+    checksum    = Column(String) # hash of output files
+
+    def __repr__(self):
+        return "<Checkpoint(step=%d, ortholog='%s')>" % (self.step, self.id_ortholog)
+
 #class Alignment(Base):
 #    """ Alignments are collections of AlignedSequences. """
 #    __tablename__ = 'alignments'
@@ -146,7 +160,7 @@ class PrimerSet(Base):
     __tablename__ = 'primer_sets'
 
     id          = Column(Integer, primary_key=True)
-    id_ortholog = Column(Integer, ForeignKey('orthologs.id'))
+    id_ortholog = Column(String, ForeignKey('orthologs.id'), index=True)
     ortholog    = relationship("Ortholog", backref="primer_sets")
     ps_idx      = Column(Integer)
     prod_len    = Column(Integer)
@@ -1,6 +1,9 @@
 from __future__ import print_function
 from discomark.models import *
 from discomark import utils
+from discomark.cache import StepCache, source_version, tool_version
+from discomark.genome import checksum
+from discomark.genome import FastaIndex
 import datetime
 import io
 import os
@@ -9,8 +12,11 @@ import shutil
 import subprocess
 import sys
 from glob import glob
+try: # StringIO has been moved to the io module in Python3
+    from StringIO import StringIO # python2
+except ImportError:
+    from io import StringIO # python3
 from Bio import SeqIO, AlignIO
-from Bio.Align import AlignInfo
 from Bio.Align import MultipleSeqAlignment
 #from Bio.Align.Applications import MafftCommandline # can only be used with python >=2.7
 from Bio.Blast import NCBIWWW, NCBIXML
@@ -27,84 +33,207 @@ def merge_species(input_dir, ortho_dir, orthologs, log_fh=sys.stderr):
     # combine species
     print("\nMerging orthologs for all species in folder %s" % ortho_dir, file=log_fh)
     for ortho in orthologs:
-        if len(ortho.sequences) > 0:
-            with open(os.path.join(ortho_dir, "%s.fasta" % ortho.id), 'wt') as f:
-                for db_seq in ortho.sequences:
-                    seq = Seq(db_seq.residues)
-                    rec = SeqRecord(seq)
-                    rec.id = db_seq.fasta_id
-                    rec.description = db_seq.description
-                    SeqIO.write(rec, f, 'fasta')
+        merge_ortholog(ortho, ortho_dir)
+
+def merge_ortholog(ortho, ortho_dir):
+    if len(ortho.sequences) > 0:
+        with open(os.path.join(ortho_dir, "%s.fasta" % ortho.id), 'wt') as f:
+            for db_seq in ortho.sequences:
+                seq = Seq(db_seq.residues)
+                rec = SeqRecord(seq)
+                rec.id = db_seq.fasta_id
+                rec.description = db_seq.description
+                SeqIO.write(rec, f, 'fasta')
 
 
 ###########################
 # 2. align ortholog files #
 ###########################
-def align_orthologs(ortho_dir, aligned_dir, orthologs, settings, log_fh=sys.stderr):
+def run_mafft(cline, out_fn, stderr=None):
+    #stdout = subprocess.check_output(cline) # won't work with python <2.7!
+    stdout = subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=stderr).communicate()[0] # this works with python <2.7
+    #mafft_cline = MafftCommandline(input=ortho_fn, localpair=True, maxiterate=16)
+    #print("\t%s " % mafft_cline)
+    # run MAFFT
+    #stdout, stderr = mafft_cline()
+    with open(out_fn, "wb") as handle:
+        handle.write(stdout)
+
+def align_orthologs(ortho_dir, aligned_dir, orthologs, settings, log_fh=sys.stderr, num_threads=1, cache=None, journal=None):
     print("\nAligning ortholog sequences...", file=log_fh)
-    # align each ortholog
+    jobs = []
+    costs = []
+    keys = []
     for o in orthologs:
-        ortho_fn = os.path.join(ortho_dir, "%s.fasta" % o.id)
-        align_fn = os.path.join(aligned_dir, '%s.fasta' % o.id)
-        # alignment makes sense only if file contains >1 sequences
-        if len(o.sequences) > 1:
-            #cline = ['mafft','--localpair','--maxiterate','16','--inputorder','--preservecase', ortho_fn]
-            cline = ['mafft'] + [x for x in sum(settings, ()) if len(x.strip())>0] + [ortho_fn]
-            print("\t%s " % ' '.join(cline), file=log_fh)
-            #stdout = subprocess.check_output(cline) # won't work with python <2.7!
-            stdout = subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=None).communicate()[0] # this works with python <2.7
-            #mafft_cline = MafftCommandline(input=ortho_fn, localpair=True, maxiterate=16)
-            #print("\t%s " % mafft_cline)
-            # run MAFFT
-            #stdout, stderr = mafft_cline()
-            with open(align_fn, "wb") as handle:
-                handle.write(stdout)
-        # otherwise just copy the ortholog file
-        elif len(o.sequences) > 0:
-            shutil.copyfile(ortho_fn, align_fn)
+        key = None
+        if journal and len(o.sequences) > 0:
+            # skip orthologs completed in an earlier run
+            key = align_key(os.path.join(ortho_dir, "%s.fasta" % o.id), settings)
+            if journal.done(o.id, key):
+                continue
+        jobs.append((o.id, len(o.sequences), ortho_dir, aligned_dir, settings, cache))
+        # estimated alignment effort: #sequences x total residues
+        costs.append(len(o.sequences) * sum([len(s.residues) for s in o.sequences]))
+        keys.append(key)
+    if journal and journal.skipped:
+        print("\t%d orthologs aligned in an earlier run" % journal.skipped, file=log_fh)
+
+    # run MAFFT (biggest orthologs are started first, output is logged in input order)
+    for job, key, output in zip(jobs, keys, utils.run_jobs(align_ortholog, jobs, num_threads, costs)):
+        log_fh.write(output)
+        align_fn = os.path.join(aligned_dir, '%s.fasta' % job[0])
+        if key and os.path.isfile(align_fn) and os.path.getsize(align_fn) > 0:
+            journal.record(job[0], key, [align_fn])
+
+def align_key(ortho_fn, settings):
+    return StepCache.key('align', tool_version(['mafft', '--version']), settings, ('file', ortho_fn))
+
+# align a single ortholog (returns log output)
+def align_ortholog(o_id, num_seqs, ortho_dir, aligned_dir, settings, cache=None):
+    ortho_fn = os.path.join(ortho_dir, "%s.fasta" % o_id)
+    align_fn = os.path.join(aligned_dir, '%s.fasta' % o_id)
+    # alignment makes sense only if file contains >1 sequences
+    if num_seqs > 1:
+        #cline = ['mafft','--localpair','--maxiterate','16','--inputorder','--preservecase', ortho_fn]
+        cline = ['mafft'] + [x for x in sum(settings, ()) if len(x.strip())>0] + [ortho_fn]
+        # reuse cached alignment if sequences, settings and MAFFT are unchanged
+        if cache:
+            key = align_key(ortho_fn, settings)
+            if cache.fetch(key, [align_fn]):
+                return "\t%s (cached)\n" % ' '.join(cline)
+        run_mafft(cline, align_fn)
+        if cache and os.path.getsize(align_fn) > 0:
+            cache.store(key, [align_fn])
+        return "\t%s \n" % ' '.join(cline)
+    # otherwise just copy the ortholog file
+    elif num_seqs > 0:
+        shutil.copyfile(ortho_fn, align_fn)
+    return ''
 
 
 ######################
 # 3. trim alignments #
 ######################
-def trim_alignments(aligned_dir, trimmed_dir, settings, log_fh=sys.stderr):
+def run_trimal(cline):
+    # collect output in a buffer of its own (jobs may run concurrently)
+    return subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+
+def trim_alignments(aligned_dir, trimmed_dir, settings, log_fh=sys.stderr, num_threads=1, cache=None, journal=None):
     print("\nTrimming alignments...", file=log_fh)
     aligned_files = next(os.walk(aligned_dir))[2]
     aligned_files = [os.path.join(aligned_dir, f) for f in os.listdir(aligned_dir) if os.path.isfile(os.path.join(aligned_dir,f))]
 
-    for f in aligned_files:
-        o_id = os.path.split(f)[1].split('.')[0]
-        out = os.path.join(trimmed_dir, "%s.fasta" % o_id)
-        trimal_params = ['trimal', '-in', f, '-out', out, '-htmlout', "%s.html" % out, '-keepheader']
-        trimal_params += [x for x in sum(settings, ()) if len(x.strip())>0]
-        subprocess.call(trimal_params, stdout=log_fh, stderr=log_fh)
+    # skip alignments trimmed in an earlier run
+    keys = [trim_key(f, settings) if journal else None for f in aligned_files]
+    todo = [i for i, f in enumerate(aligned_files) if not (journal and journal.done(os.path.split(f)[1].split('.')[0], keys[i]))]
+    if journal and journal.skipped:
+        print("\t%d alignments trimmed in an earlier run" % journal.skipped, file=log_fh)
+
+    jobs = [(aligned_files[i], trimmed_dir, settings, cache) for i in todo]
+    costs = [os.path.getsize(aligned_files[i]) for i in todo]
+
+    # run trimAl, write output to log file in input order
+    for i, output in zip(todo, utils.run_jobs(trim_alignment, jobs, num_threads, costs)):
+        log_fh.write(output.decode('utf-8', 'replace'))
+        log_fh.flush()
+        o_id = os.path.split(aligned_files[i])[1].split('.')[0]
+        out_fns = trim_outputs(trimmed_dir, o_id)
+        if journal and all([os.path.isfile(fn) for fn in out_fns]):
+            journal.record(o_id, keys[i], out_fns)
+
+def trim_key(aln_fn, settings):
+    return StepCache.key('trim', tool_version(['trimal', '--version']), settings, ('file', aln_fn))
+
+def trim_outputs(trimmed_dir, o_id):
+    out = os.path.join(trimmed_dir, "%s.fasta" % o_id)
+    return [out, "%s.html" % out]
+
+# trim a single alignment (returns trimAl's output)
+def trim_alignment(f, trimmed_dir, settings, cache=None):
+    o_id = os.path.split(f)[1].split('.')[0]
+    out_fns = trim_outputs(trimmed_dir, o_id)
+    out = out_fns[0]
+    trimal_params = ['trimal', '-in', f, '-out', out, '-htmlout', "%s.html" % out, '-keepheader']
+    trimal_params += [x for x in sum(settings, ()) if len(x.strip())>0]
+    # reuse cached output if alignment, settings and trimAl are unchanged
+    if cache:
+        key = trim_key(f, settings)
+        if cache.fetch(key, out_fns):
+            return ("\t%s (cached)\n" % ' '.join(trimal_params)).encode('utf-8')
+    output = run_trimal(trimal_params)
+    if cache and all([os.path.isfile(fn) for fn in out_fns]):
+        cache.store(key, out_fns)
+    return output
 
 
 # create BLAST database for reference alignment
-def makeblastdb(genome, log_fh=sys.stderr):
+# (returns database path, which is in the genome cache if one is given)
+def makeblastdb(genome, log_fh=sys.stderr, genome_cache=None):
+    if genome_cache:
+        return genome_cache.blast_db(genome, log_fh)
     path, filename = os.path.split(genome)
     cline = ['makeblastdb', '-in', genome, '-dbtype', 'nucl']
     print("\t%s\n" % ' '.join(cline), file=log_fh)
     subprocess.call(cline, stdout=log_fh, stderr=log_fh)
+    return genome
 
 ###################################
 # 4. map against reference genome #
 ###################################
-def map_to_reference(query_dir, mapped_dir, genome, settings, log_fh=sys.stderr):
-    # create the BLAST db to map against
-    print("\nCreating BLAST database from reference...", file=log_fh)
-    makeblastdb(genome, log_fh)
+def run_blast(cline):
+    # returns (stdout, stderr)
+    return cline()
+
+# sequences mapped against the reference:
+#  - 'all': every aligned sequence
+#  - 'consensus': consensus sequence of each alignment
+#  - 'longest': longest sequence of each alignment
+# (representatives are named after the ortholog, see DataBroker.load_blast_hits)
+MAP_MODES = ('all', 'consensus', 'longest')
+
+def consensus_sequence(seqs):
+    # most frequent residue in each alignment column, gaps are ignored
+    # (ties are broken alphabetically, columns with gaps only are dropped)
+    residues = []
+    for col in zip(*[s.upper() for s in seqs]):
+        counts = {}
+        for c in col:
+            if c != '-':
+                counts[c] = counts.get(c, 0) + 1
+        if counts:
+            residues.append(max(sorted(counts.items()), key=lambda x: x[1])[0])
+    return ''.join(residues)
+
+def map_to_reference(query_dir, mapped_dir, genome, settings, log_fh=sys.stderr, num_threads=1, genome_cache=None, mode='all', blast_db=None):
+    # create the BLAST db to map against (unless it has been created before)
+    if blast_db is None:
+        print("\nCreating BLAST database from reference...", file=log_fh)
+        blast_db = makeblastdb(genome, log_fh, genome_cache)
 
     # combine query sequences into a single FASTA file
     query_files = glob(os.path.join(query_dir, '*.fasta'))
     query_fn = os.path.join(mapped_dir, 'query.fasta')
     query_file = open(query_fn, 'wt')
+    query_lens = []
     for f in query_files:
         o_id = os.path.split(f)[1].split('.')[0]
+        if mode != 'all':
+            seqs = [str(rec.seq) for rec in SeqIO.parse(f, 'fasta')]
+            if len(seqs) == 0:
+                continue
+            if mode == 'consensus':
+                s = consensus_sequence(seqs)
+            else:
+                s = max(seqs, key=lambda x: len(x) - x.count('-')).replace('-', '')
+            rec = SeqRecord(Seq(s), id=o_id, description="%s of %d sequences" % (mode, len(seqs)))
+            query_file.write(rec.format('fasta'))
+            query_lens.append(len(s))
+            continue
         for rec in SeqIO.parse(f, 'fasta'):
           s = str(rec.seq).replace('-', 'N')
           rec.seq = Seq(s)
           query_file.write(rec.format('fasta'))
+          query_lens.append(len(s))
     query_file.close()
 
     # run BLAST
@@ -112,59 +241,209 @@ def map_to_reference(query_dir, mapped_dir, genome, settings, log_fh=sys.stderr)
     out_fn = os.path.join(mapped_dir, 'blast.out')
     # blast_options = ['-query', query_fn, '-db', genome, '-out', out_fn]
     # cline = ['blastn'] + blast_options
-    cline = NcbiblastnCommandline(query=query_fn, db=genome, out=out_fn, outfmt='"6 std sstrand"', **dict(settings))
-    print("\t%s\n" % cline, file=log_fh)
-    stdout, stderr = cline()
+    # (queries are split into chunks searched by parallel BLAST processes,
+    # unless BLAST's own threading has been configured)
+    blast_threads = [k for k, v in settings if k.strip().lstrip('-') == 'num_threads']
+    num_chunks = 1 if blast_threads else min(num_threads, len(query_lens))
+    if num_chunks <= 1:
+        cline = NcbiblastnCommandline(query=query_fn, db=blast_db, out=out_fn, outfmt='"6 std sstrand"', **dict(settings))
+        print("\t%s\n" % cline, file=log_fh)
+        stdout, stderr = cline()
+        return out_fn
+
+    # contiguous chunks of similar total length, so that the merged output
+    # has the queries in the same order as query.fasta
+    bounds = [0]
+    total = sum(query_lens)
+    cum_len = 0
+    for i, l in enumerate(query_lens):
+        cum_len += l
+        if len(bounds) < num_chunks and cum_len * num_chunks >= total * len(bounds):
+            bounds.append(i+1)
+    if bounds[-1] < len(query_lens):
+        bounds.append(len(query_lens))
+
+    jobs = []
+    costs = []
+    recs = SeqIO.parse(query_fn, 'fasta')
+    for i in range(len(bounds)-1):
+        chunk_fn = os.path.join(mapped_dir, 'query.%d.fasta' % i)
+        with open(chunk_fn, 'wt') as chunk_file:
+            for j in range(bounds[i], bounds[i+1]):
+                chunk_file.write(next(recs).format('fasta'))
+        cline = NcbiblastnCommandline(query=chunk_fn, db=blast_db, out=os.path.join(mapped_dir, 'blast.%d.out' % i),
+                                      outfmt='"6 std sstrand"', **dict(settings))
+        jobs.append((cline,))
+        costs.append(sum(query_lens[bounds[i]:bounds[i+1]]))
+
+    # run chunks in parallel (biggest first), merge outputs in chunk order
+    results = utils.run_jobs(run_blast, jobs, num_threads, costs)
+    with open(out_fn, 'wt') as out_f:
+        for i, (cline,) in enumerate(jobs):
+            print("\t%s\n" % cline, file=log_fh)
+            next(results)
+            chunk_out = os.path.join(mapped_dir, 'blast.%d.out' % i)
+            with open(chunk_out, 'rt') as chunk_f:
+                shutil.copyfileobj(chunk_f, out_f)
+            os.remove(chunk_out)
+            os.remove(os.path.join(mapped_dir, 'query.%d.fasta' % i))
 
     return out_fn
 
-def add_reference(source_dir, target_dir, genome, hits, mafft_settings, log_fh):
+# open FASTA index of the reference (None if it cannot be indexed)
+def reference_index(genome, log_fh=sys.stderr, genome_cache=None):
+    try:
+        return genome_cache.fasta_index(genome) if genome_cache else FastaIndex(genome)
+    except ValueError as e:
+        print("[WARNING] %s, cannot index reference." % e, file=log_fh)
+        return None
+
+# iterate over the reference sequences with mapped orthologs
+# -> (ref id, FASTA header, length, function returning the slice [start, end))
+def reference_records(genome, hits, log_fh=sys.stderr, genome_cache=None):
+    fai = reference_index(genome, log_fh, genome_cache)
+    if fai is None:
+        # irregular line lengths: fall back to parsing the whole reference
+        for rec in SeqIO.parse(open(genome, 'rt'), 'fasta'):
+            if rec.id in hits:
+                yield (rec.id, rec.description, len(rec), lambda start, end, rec=rec: str(rec.seq[start:end]))
+        return
+
+    try:
+        for ref_id in fai.names:
+            if ref_id in hits:
+                yield (ref_id, fai.description(ref_id), fai.length(ref_id), lambda start, end, ref_id=ref_id: fai.fetch(ref_id, start, end))
+    finally:
+        fai.close()
+
+# modes of including the reference slice:
+#  - 'realign': align ortholog sequences and reference from scratch
+#  - 'add', 'addfragments': insert the reference into the existing ortholog
+#    alignment using MAFFT's --add/--addfragments (ortholog alignment is kept)
+REF_MODES = ('realign', 'add', 'addfragments')
+
+def add_reference(source_dir, target_dir, genome, hits, mafft_settings, log_fh, num_threads=1, mode='realign', genome_cache=None, cache=None, journal=None):
+    # skip orthologs realigned in an earlier run
+    keys = {}
+    done = set()
+    if journal:
+        genome_sum = checksum(genome)
+        for ref_id, ref_hits in hits.items():
+            for rec_hits in ref_hits:
+                o_id = rec_hits['ortholog']
+                keys[o_id] = reference_key(os.path.join(source_dir, "%s.fasta" % o_id), genome_sum, ref_id, rec_hits, mafft_settings, mode)
+                if journal.done(o_id, keys[o_id]):
+                    done.add(o_id)
+        hits = dict((ref_id, [h for h in ref_hits if h['ortholog'] not in done]) for ref_id, ref_hits in hits.items())
+        hits = dict((ref_id, ref_hits) for ref_id, ref_hits in hits.items() if ref_hits)
+
     # copy all source alignments to target dir (so alignments without ref mapping don't get lost)
     for f in glob(os.path.join(source_dir, '*.fasta')):
-        shutil.copy(f, target_dir)
+        if os.path.basename(f).split('.')[0] not in done:
+            shutil.copy(f, target_dir)
 
     # combine ortholog and reference sequences
-    for rec in SeqIO.parse(open(genome, 'rt'), 'fasta'):
-        if rec.id in hits:
-            for rec_hits in hits[rec.id]:
-                in_fn  = os.path.join(target_dir, "%s.fasta" % rec_hits['ortholog'])
-                out_fn = os.path.join(target_dir, "%s.ref.fa" % rec_hits['ortholog'])
-                directions = set() # store set of mapping directions
-                with open(out_fn, 'wt') as out_f:
-                    # write out ortholog sequences
-                    for seq in SeqIO.parse(in_fn, 'fasta'):
-                        if seq.id in rec_hits['seqs']:
-                            directions.add(rec_hits['seqs'][seq.id])
-                        else:
-                            print("[WARNING] ortholog sequence '%s' not found in Blast hits." % seq.id, file=log_fh)
-                        SeqIO.write(seq, out_f, 'fasta')
-                    if len(directions) > 1:
-                        print("[WARNING] reference seq '%s' has ortholog seqs mapped in both directions, thus it will not be included in the alignment." % rec.id, file=log_fh)
-                    else:
-                        # retrieve relevant slice of reference
-                        start = max(0, rec_hits['range'][0]-100)
-                        end = min(len(rec), rec_hits['range'][1]+100)
-                        rec_slice = rec[start:end]
-
-                        orientation = directions.pop()
-                        # reverse complement reference if necessary
-                        if orientation == 'minus':
-                            rec_slice.seq = rec_slice.seq.reverse_complement()
-                            rec_slice.id = rec_slice.id + '_rv'
-
-                        SeqIO.write(rec_slice.upper(), out_f, 'fasta')
+    ref_files = []
+    for ref_id, ref_desc, ref_len, fetch in reference_records(genome, hits, log_fh, genome_cache):
+        for rec_hits in hits[ref_id]:
+            write_reference_file(target_dir, rec_hits, ref_id, ref_desc, ref_len, fetch, mode, log_fh)
+            ref_files.append(os.path.join(target_dir, "%s.ref.fa" % rec_hits['ortholog']))
 
     # align combined files using MAFFT
-    print("Realigning Orthologs (including reference)...", file=log_fh)
-    for f in glob(os.path.join(target_dir, '*.ref.fa')):
-        o_id = os.path.split(f)[1].split('.')[0]
-        # run MAFFT (preserve input order, so ref seq is last)
-        cline = ['mafft'] + [x for x in sum(mafft_settings, ()) if len(x.strip())>0] + [f]
-        print("\t%s " % ' '.join(cline), file=log_fh)
-        stdout = subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=log_fh).communicate()[0] # this works with python <2.7
-
-        with open(os.path.join(target_dir, '%s.fasta' % o_id), 'wb') as handle:
-            handle.write(stdout)
+    if mode == 'realign':
+        print("Realigning Orthologs (including reference)...", file=log_fh)
+    else:
+        print("Adding reference to ortholog alignments (MAFFT --%s)..." % mode, file=log_fh)
+    if done:
+        print("\t%d orthologs realigned in an earlier run" % len(done), file=log_fh)
+    ref_files.sort()
+    jobs = [(f, mafft_settings, mode, cache) for f in ref_files]
+    costs = [os.path.getsize(f if mode == 'realign' else f[:-len('.ref.fa')] + '.fasta') for f in ref_files]
+
+    # biggest files are started first, output is logged in input order
+    for f, (success, output) in zip(ref_files, utils.run_jobs(realign_ortholog, jobs, num_threads, costs)):
+        log_fh.write(output)
+        log_fh.flush()
+        o_id = os.path.basename(f)[:-len('.ref.fa')]
+        if journal and success:
+            journal.record(o_id, keys[o_id], [os.path.join(target_dir, "%s.fasta" % o_id)])
+
+def reference_key(aln_fn, genome_sum, ref_id, rec_hits, mafft_settings, mode):
+    # source alignment, reference slice (given by genome, hits) and MAFFT settings
+    return StepCache.key('add_reference', tool_version(['mafft', '--version']), mafft_settings, mode, genome_sum,
+                         ref_id, rec_hits['range'], sorted(rec_hits['seqs'].items()), ('file', aln_fn))
+
+# write ortholog alignment and reference slice to '<ortholog>.ref.fa'
+# (only the reference slice if it is added to the existing alignment)
+def write_reference_file(target_dir, rec_hits, ref_id, ref_desc, ref_len, fetch, mode, log_fh):
+    in_fn  = os.path.join(target_dir, "%s.fasta" % rec_hits['ortholog'])
+    out_fn = os.path.join(target_dir, "%s.ref.fa" % rec_hits['ortholog'])
+    directions = set() # store set of mapping directions
+    with open(out_fn, 'wt') as out_f:
+        # write out ortholog sequences (unless the reference is added to their alignment)
+        for seq in SeqIO.parse(in_fn, 'fasta'):
+            if seq.id in rec_hits['seqs']:
+                directions.add(rec_hits['seqs'][seq.id])
+            else:
+                print("[WARNING] ortholog sequence '%s' not found in Blast hits." % seq.id, file=log_fh)
+            if mode == 'realign':
+                SeqIO.write(seq, out_f, 'fasta')
+        if len(directions) > 1:
+            print("[WARNING] reference seq '%s' has ortholog seqs mapped in both directions, thus it will not be included in the alignment." % ref_id, file=log_fh)
+        else:
+            # retrieve relevant slice of reference
+            start = max(0, rec_hits['range'][0]-100)
+            end = min(ref_len, rec_hits['range'][1]+100)
+            rec_slice = SeqRecord(Seq(fetch(start, end)), id=ref_id, description=ref_desc)
+
+            orientation = directions.pop()
+            # reverse complement reference if necessary
+            if orientation == 'minus':
+                rec_slice.seq = rec_slice.seq.reverse_complement()
+                rec_slice.id = rec_slice.id + '_rv'
+
+            SeqIO.write(rec_slice.upper(), out_f, 'fasta')
+
+# align '<ortholog>.ref.fa' into '<ortholog>.fasta' (returns (success, log output))
+def realign_ortholog(ref_fn, mafft_settings, mode='realign', cache=None):
+    aln_fn = ref_fn[:-len('.ref.fa')] + '.fasta'
+    # run MAFFT (preserve input order, so ref seq is last)
+    cline = ['mafft'] + [x for x in sum(mafft_settings, ()) if len(x.strip())>0]
+    if mode == 'realign':
+        cline += [ref_fn]
+    elif os.path.getsize(ref_fn) > 0:
+        cline += ['--%s' % mode, ref_fn, aln_fn]
+    else: # no reference slice to add
+        return (True, '')
+    # reuse cached alignment if input, settings and MAFFT are unchanged
+    if cache:
+        key = cache.key('add_reference', tool_version(['mafft', '--version']), mafft_settings, mode,
+                        ('file', ref_fn), ('file', aln_fn) if mode != 'realign' else '')
+        if cache.fetch(key, [aln_fn]):
+            return (True, "\t%s (cached)\n" % ' '.join(cline))
+
+    output = "\t%s \n" % ' '.join(cline)
+    success, messages = realign_with_reference(cline, aln_fn)
+    output += messages.decode('utf-8', 'replace')
+    if not success:
+        output += "[WARNING] realignment failed, keeping alignment without reference: %s\n" % aln_fn
+    elif cache:
+        cache.store(key, [aln_fn])
+    return (success, output)
+
+def realign_with_reference(cline, out_fn):
+    # the alignment is only replaced if MAFFT succeeds, MAFFT's messages are
+    # returned (jobs may run concurrently)
+    try:
+        proc = subprocess.Popen(cline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        return (False, ("%s\n" % e).encode('utf-8'))
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0 or len(stdout.strip()) == 0:
+        return (False, stderr)
+    with open(out_fn, 'wb') as handle:
+        handle.write(stdout)
+    return (True, stderr)
 
 # alternative handling if no reference was provided
 def convertFastaToClustal(in_dir, out_dir):
@@ -178,32 +457,88 @@ def convertFastaToClustal(in_dir, out_dir):
 # 5. design primers #
 #####################
 
-def design_primers(source_dir, target_dir, settings, logfile):
+def find_primers_in_file(aln_fn, config):
+    aln = prifipy.AlignmentMatrix(AlignIO.read(aln_fn, 'fasta'))
+    l = aln.get_alignment_length()
+    # collect PriFi messages, they are written to the log by the caller
+    log_buf = StringIO()
+    primerpairs = prifipy.findprimers(0, aln, None, l, config, log_buf)
+    return (primerpairs, log_buf.getvalue())
+
+def design_primers(source_dir, target_dir, settings, logfile, num_procs=1, cache=None, journal=None):
     print("\nDesigning primers using PriFi...\n", file=logfile)
-    # get rid of previous files
-    utils.purge_dir(target_dir)
     aln_files = glob(os.path.join(source_dir, '*.fasta'))
+    # skip alignments with primers from an earlier run
+    done = {}
+    if journal:
+        for f in aln_files:
+            o_id = os.path.basename(f).split('.')[0]
+            if journal.done(o_id, primers_key(f, settings)):
+                done[os.path.basename(f)] = journal.outputs(o_id)
+        if done:
+            print("\t%d alignments with primers from an earlier run" % len(done), file=logfile)
+    # get rid of previous files
+    utils.purge_dir(target_dir, keep=sum(done.values(), []))
     print("\tChecking for empty alignments...", file=logfile)
     for f in aln_files:
-        try:
-            align = AlignIO.read(f, 'fasta')
-            filename = os.path.basename(f)
-            shutil.copyfile(f, os.path.join(target_dir, filename))
-        except Exception:
-            print("[WARNING] Empty alignment file?! (%s)" % f, file=logfile)
-            continue
+        if os.path.basename(f) not in done:
+            copy_alignment(f, target_dir, logfile)
 
     # call PriFi for actual primer design
-    for f in glob(os.path.join(target_dir, '*.fasta')):
-        aln = AlignIO.read(f, 'fasta')
-        summary = AlignInfo.SummaryInfo(aln)
-        l = aln.get_alignment_length()
-        primerpairs = prifipy.findprimers(0, list(aln), summary, l, settings, logfile)
-        if not primerpairs:
-            print("%s: No valid primer pair found" % f, file=logfile)
+    # (workers only compute primers, files are written here in input order)
+    config = prifipy.PrimerDesignConfig(settings)
+    jobs = [(f, config) for f in glob(os.path.join(target_dir, '*.fasta')) if os.path.basename(f) not in done]
+    # reuse cached primers if alignment, settings and PriFi are unchanged
+    keys = {}
+    cached = {}
+    if cache or journal:
+        for i, (f, _) in enumerate(jobs):
+            keys[i] = primers_key(f, settings)
+    if cache:
+        for i, (f, _) in enumerate(jobs):
+            res = cache.load(keys[i])
+            if res is not None:
+                cached[i] = res
+    todo = [i for i in range(len(jobs)) if i not in cached]
+    costs = [os.path.getsize(jobs[i][0]) for i in todo]
+    results = utils.run_jobs(find_primers_in_file, [jobs[i] for i in todo], num_procs, costs, processes=True)
+    for i, (f, _) in enumerate(jobs):
+        if i in cached:
+            primerpairs, output = cached[i]
         else:
-            print('%s: Found %d primer pair suggestions. Writing primer files:' % (f, len(primerpairs)), file=logfile)
-            prifipy.writePrimersToFiles(f, primerpairs, 1, logfile)
+            primerpairs, output = next(results)
+            if cache:
+                cache.save(keys[i], (primerpairs, output))
+        write_primers(f, primerpairs, output, logfile)
+        if journal:
+            journal.record(os.path.basename(f).split('.')[0], keys[i], primer_outputs(f))
+
+# copy alignment to primer folder (returns new path, None if alignment is empty)
+def copy_alignment(f, target_dir, logfile):
+    try:
+        align = AlignIO.read(f, 'fasta')
+        filename = os.path.basename(f)
+        shutil.copyfile(f, os.path.join(target_dir, filename))
+        return os.path.join(target_dir, filename)
+    except Exception:
+        print("[WARNING] Empty alignment file?! (%s)" % f, file=logfile)
+        return None
+
+def primers_key(aln_fn, settings):
+    return StepCache.key('design_primers', source_version(os.path.dirname(prifipy.__file__)), settings, ('file', aln_fn))
+
+# alignment and primer files written for it
+def primer_outputs(f):
+    return [f] + sorted(glob(f + '.*'))
+
+# write PriFi log and primer files of an alignment
+def write_primers(f, primerpairs, output, logfile):
+    logfile.write(output)
+    if not primerpairs:
+        print("%s: No valid primer pair found" % f, file=logfile)
+    else:
+        print('%s: Found %d primer pair suggestions. Writing primer files:' % (f, len(primerpairs)), file=logfile)
+        prifipy.writePrimersToFiles(f, primerpairs, 1, logfile)
 
 def design_primers_cl(source_dir, target_dir, prifi, logfile):
     print("\nDesigning primers using PriFi...\n", file=logfile)
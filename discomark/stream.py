@@ -0,0 +1,358 @@
+"""Per-ortholog streaming of pipeline steps 1-5.
+
+In streaming mode, an ortholog is passed on to its next step as soon as its
+previous step has finished (merge -> align -> trim -> primer design), rather
+than waiting for all orthologs to complete a step. External tools (MAFFT,
+trimAl, BLAST) run in a thread pool and PriFi in a process pool, with the
+total number of running jobs limited to the number of threads. Mapping to
+the reference is a side stage run on batches of aligned orthologs: once the
+BLAST hits of a batch are loaded, its orthologs are realigned with their
+reference slice and continue to primer design. All database access and log
+output happen in the main thread. If journals are given, orthologs completed
+in an earlier run are skipped in each step (see discomark.journal).
+
+"""
+
+from __future__ import division, print_function
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from glob import glob
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+try: # Queue module has been renamed in Python3
+    import queue # python3
+except ImportError:
+    import Queue as queue # python2
+try: # StringIO has been moved to the io module in Python3
+    from StringIO import StringIO # python2
+except ImportError:
+    from io import StringIO # python3
+from Bio import SeqIO
+from discomark import steps, utils
+from discomark.genome import checksum, open_cache
+import prifipy
+
+# order in which ready jobs are started (orthologs close to completion first)
+PRIORITIES = {'primers': 0, 'realign': 1, 'trim': 2, 'align': 3}
+# interval (seconds) at which running jobs are checked while waiting for results
+POLL_INTERVAL = 5
+
+def _call(func, args):
+    # run a job in a worker, return (result, formatted exception)
+    try:
+        return func(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def _map_batch(query_dir, genome, settings, mode, blast_db):
+    # BLAST the alignments in query_dir, return (hits file, log output)
+    log_fh = StringIO()
+    out_fn = steps.map_to_reference(query_dir, query_dir, genome, settings, log_fh, 1, None, mode, blast_db)
+    return out_fn, log_fh.getvalue()
+
+
+class StreamingPipeline(object):
+    """Runs steps 1-5 of a project for each ortholog independently.
+
+    Produces the same files as the separate steps (merge_species,
+    align_orthologs, trim_alignments, map_to_reference/add_reference and
+    design_primers), except that log output is written in order of
+    completion.
+    """
+
+    def __init__(self, project_dir, model, config, log_fh=sys.stderr, num_threads=1, do_ref_map=False,
+                 map_mode='all', ref_mode='realign', trim=True, cache=None, journals=None):
+        self.model = model
+        self.log_fh = log_fh
+        self.num_threads = num_threads
+        self.do_ref_map = do_ref_map
+        self.map_mode = map_mode
+        self.ref_mode = ref_mode
+        self.trim = trim
+        self.cache = cache
+        self.journals = journals if journals else {} # step number -> StepJournal
+
+        d = lambda name: os.path.join(project_dir, config.get('Data', name))
+        self.ortho_dir, self.aligned_dir, self.trimmed_dir = d('ortho_dir'), d('aligned_dir'), d('trimmed_dir')
+        self.mapped_dir, self.primer_dir = d('mapped_dir'), d('primer_dir')
+        self.reference = os.path.join(d('reference_dir'), 'genome.fasta')
+        self.genome_cache = open_cache(config)
+        self.map_batch = config.getint('Data', 'stream_map_batch') if config.has_option('Data', 'stream_map_batch') else 100
+
+        self.settings = {
+            'align':   config.items('02_MAFFT_settings'),
+            'trim':    config.items('03_TrimAl_settings'),
+            'map':     config.items('04_BLAST_settings'),
+            'realign': config.items('04_MAFFT_settings'),
+            'primers': config.items('05_PriFi_settings'),
+        }
+        self.primer_config = prifipy.PrimerDesignConfig(self.settings['primers'])
+
+    def __repr__(self):
+        return "<StreamingPipeline(threads=%d, ref_map=%s)>" % (self.num_threads, self.do_ref_map)
+
+    def run(self, orthologs):
+        self.ready = []      # heap of jobs waiting for a free thread
+        self.counter = 0     # tie breaker for jobs of equal priority
+        self.running = 0     # number of submitted jobs
+        self.pending = {}    # job number -> (stage, ortholog, AsyncResult)
+        self.aligning = 0    # orthologs queued or running in alignment
+        self.to_map = []     # aligned orthologs waiting for reference mapping
+        self.mapping = None  # orthologs of the running BLAST batch
+        self.hits_loaded = False
+        self.primer_keys = {}
+        self.keys = {}       # (step, ortholog) -> journal key
+        self.done = queue.Queue()
+
+        print("\nProcessing orthologs in streaming mode...", file=self.log_fh)
+        # get rid of previous primer files (except those recorded in the journal)
+        journal = self.journals.get(5)
+        utils.purge_dir(self.primer_dir, sum([journal.outputs(o_id) for o_id in journal.entries], []) if journal else [])
+        self.blast_db = None
+        self.ref_fai = None
+        self.ref_recs = None
+        self.genome_sum = None
+        if self.do_ref_map:
+            print("\nCreating BLAST database from reference...", file=self.log_fh)
+            self.blast_db = steps.makeblastdb(self.reference, self.log_fh, self.genome_cache)
+            self.ref_fai = steps.reference_index(self.reference, self.log_fh, self.genome_cache)
+            if self.ref_fai is None: # irregular line lengths
+                self.ref_recs = SeqIO.index(self.reference, 'fasta')
+            if 4 in self.journals:
+                self.genome_sum = checksum(self.reference)
+
+        # biggest orthologs are aligned first
+        for o in orthologs:
+            if len(o.sequences) > 0:
+                cost = len(o.sequences) * sum([len(s.residues) for s in o.sequences])
+                self._push('align', o.id, None, (o,), -cost)
+                self.aligning += 1
+
+        self.procs = Pool(self.num_threads)
+        self.threads = ThreadPool(self.num_threads)
+        self.worker_pids = set([p.pid for p in self.procs._pool])
+        try:
+            while True:
+                self._schedule()
+                if self.running == 0:
+                    break
+                try:
+                    job, (result, error) = self.done.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    self._check_jobs()
+                    continue
+                stage, o_id, _ = self.pending.pop(job)
+                self.running -= 1
+                if error:
+                    raise RuntimeError("%s job for '%s' failed:\n%s" % (stage, o_id, error))
+                getattr(self, '_%s_done' % stage)(o_id, result)
+                self.log_fh.flush()
+        finally:
+            for pool in (self.threads, self.procs):
+                pool.terminate()
+                pool.join()
+            for ref in (self.ref_fai, self.ref_recs):
+                if ref is not None:
+                    ref.close()
+
+        if self.do_ref_map:
+            self.model.update_uniq_ref_flag()
+        for step, journal in sorted(self.journals.items()):
+            if journal.skipped:
+                print("\t%d orthologs skipped in step %d (completed in an earlier run)" % (journal.skipped, step), file=self.log_fh)
+
+    def _push(self, stage, o_id, func, args, order=None):
+        self.counter += 1
+        heapq.heappush(self.ready, (PRIORITIES[stage], self.counter if order is None else order, self.counter,
+                                    stage, o_id, func, args))
+
+    def _schedule(self):
+        # start ready jobs while threads are available
+        while self.running < self.num_threads:
+            # map a batch when enough orthologs are waiting (or no more will come)
+            if self.to_map and not self.mapping and (len(self.to_map) >= self.map_batch or self.aligning == 0):
+                self._start_map()
+            elif self.ready:
+                _, _, _, stage, o_id, func, args = heapq.heappop(self.ready)
+                if stage == 'align':
+                    # merging reads from the database, so it happens here
+                    o = args[0]
+                    steps.merge_ortholog(o, self.ortho_dir)
+                    if self._skip(2, o.id, steps.align_key, os.path.join(self.ortho_dir, '%s.fasta' % o.id), self.settings['align']):
+                        self._align_done(o.id, '')
+                        continue
+                    func, args = steps.align_ortholog, (o.id, len(o.sequences), self.ortho_dir, self.aligned_dir,
+                                                        self.settings['align'], self.cache)
+                self._submit(stage, o_id, func, args)
+            else:
+                break
+
+    def _submit(self, stage, o_id, func, args):
+        pool = self.procs if stage == 'primers' else self.threads
+        self.counter += 1
+        job = self.counter
+        kwargs = {'callback': lambda res: self.done.put((job, res))}
+        if sys.version_info[0] >= 3: # errors outside of the job (e.g. result cannot be pickled)
+            kwargs['error_callback'] = lambda e: self.done.put((job, (None, repr(e))))
+        self.pending[job] = (stage, o_id, pool.apply_async(_call, (func, args), **kwargs))
+        self.running += 1
+
+    def _check_jobs(self):
+        # jobs can end without a result: python2 pools don't report errors
+        # outside of the job, and process pools silently replace workers that
+        # died (e.g. killed by the OOM killer), losing their jobs
+        for stage, o_id, res in list(self.pending.values()):
+            if res.ready() and not res.successful():
+                try:
+                    res.get()
+                except Exception as e:
+                    raise RuntimeError("%s job for '%s' failed: %r" % (stage, o_id, e))
+        if set([p.pid for p in self.procs._pool]) != self.worker_pids:
+            raise RuntimeError("a primer design process died (out of memory?), its results are lost")
+
+    def _skip(self, step, o_id, key_func, *args):
+        # check if ortholog was completed in an earlier run, otherwise keep the
+        # key to record it when done
+        journal = self.journals.get(step)
+        if journal is None:
+            return False
+        key = key_func(*args)
+        if journal.done(o_id, key):
+            return True
+        self.keys[(step, o_id)] = key
+        return False
+
+    def _record(self, step, o_id, fns):
+        key = self.keys.pop((step, o_id), None)
+        if key is not None:
+            self.journals[step].record(o_id, key, fns)
+
+    def _align_done(self, o_id, output):
+        self.log_fh.write(output)
+        self.aligning -= 1
+        aln_fn = os.path.join(self.aligned_dir, '%s.fasta' % o_id)
+        if os.path.isfile(aln_fn) and os.path.getsize(aln_fn) > 0:
+            self._record(2, o_id, [aln_fn])
+        if self.trim:
+            if self._skip(3, o_id, steps.trim_key, aln_fn, self.settings['trim']):
+                self._trim_done(o_id, b'')
+            else:
+                self._push('trim', o_id, steps.trim_alignment, (aln_fn, self.trimmed_dir, self.settings['trim'], self.cache))
+        if self.do_ref_map:
+            self.to_map.append(o_id)
+        elif not self.trim:
+            self._start_primers(o_id, aln_fn)
+
+    def _trim_done(self, o_id, output):
+        self.log_fh.write(output.decode('utf-8', 'replace'))
+        out_fns = steps.trim_outputs(self.trimmed_dir, o_id)
+        if all([os.path.isfile(fn) for fn in out_fns]):
+            self._record(3, o_id, out_fns)
+        if not self.do_ref_map:
+            self._start_primers(o_id, os.path.join(self.trimmed_dir, '%s.fasta' % o_id))
+
+    def _start_map(self):
+        batch, self.to_map = self.to_map[:self.map_batch], self.to_map[self.map_batch:]
+        query_dir = tempfile.mkdtemp(prefix='batch.', dir=self.mapped_dir)
+        for o_id in batch:
+            shutil.copy(os.path.join(self.aligned_dir, '%s.fasta' % o_id), query_dir)
+        self.mapping = batch
+        self._submit('map', query_dir, _map_batch,
+                     (query_dir, self.reference, self.settings['map'], self.map_mode, self.blast_db))
+
+    def _map_done(self, query_dir, result):
+        batch, self.mapping = self.mapping, None
+        out_fn, output = result
+        self.log_fh.write(output)
+        self.model.load_blast_hits(out_fn, add=self.hits_loaded, per_ortholog=(self.map_mode != 'all'))
+        # keep queries and hits of all batches (as written by map_to_reference)
+        for fn in ('query.fasta', 'blast.out'):
+            with open(os.path.join(self.mapped_dir, fn), 'at' if self.hits_loaded else 'wt') as out_f:
+                with open(os.path.join(query_dir, fn), 'rt') as in_f:
+                    shutil.copyfileobj(in_f, out_f)
+        self.hits_loaded = True
+        shutil.rmtree(query_dir)
+
+        # skip orthologs realigned in an earlier run
+        hits = self.model.get_best_hits(batch)
+        realigned = set()
+        for ref_id, ref_hits in hits.items():
+            for rec_hits in ref_hits:
+                o_id = rec_hits['ortholog']
+                if self._skip(4, o_id, steps.reference_key, os.path.join(self.aligned_dir, '%s.fasta' % o_id),
+                              self.genome_sum, ref_id, rec_hits, self.settings['realign'], self.ref_mode):
+                    realigned.add(o_id)
+        # copy alignments (so alignments without ref mapping don't get lost)
+        for o_id in batch:
+            if o_id not in realigned:
+                shutil.copy(os.path.join(self.aligned_dir, '%s.fasta' % o_id), self.mapped_dir)
+        # combine ortholog and reference sequences of mapped orthologs
+        mapped = set()
+        for ref_id, ref_hits in hits.items():
+            ref_hits = [h for h in ref_hits if h['ortholog'] not in realigned]
+            if not ref_hits:
+                continue
+            ref_desc, ref_len, fetch = self._reference(ref_id)
+            for rec_hits in ref_hits:
+                steps.write_reference_file(self.mapped_dir, rec_hits, ref_id, ref_desc, ref_len, fetch,
+                                           self.ref_mode, self.log_fh)
+                mapped.add(rec_hits['ortholog'])
+        for o_id in batch:
+            if o_id in mapped:
+                ref_fn = os.path.join(self.mapped_dir, '%s.ref.fa' % o_id)
+                self._push('realign', o_id, steps.realign_ortholog, (ref_fn, self.settings['realign'], self.ref_mode, self.cache))
+            else:
+                self._start_primers(o_id, os.path.join(self.mapped_dir, '%s.fasta' % o_id))
+
+    def _reference(self, ref_id):
+        # FASTA header, length and function returning the slice [start, end) of a reference sequence
+        if self.ref_fai is not None:
+            fai = self.ref_fai
+            return fai.description(ref_id), fai.length(ref_id), lambda start, end: fai.fetch(ref_id, start, end)
+        rec = self.ref_recs[ref_id]
+        return rec.description, len(rec), lambda start, end: str(rec.seq[start:end])
+
+    def _realign_done(self, o_id, result):
+        success, output = result
+        self.log_fh.write(output)
+        aln_fn = os.path.join(self.mapped_dir, '%s.fasta' % o_id)
+        if success:
+            self._record(4, o_id, [aln_fn])
+        else:
+            self.keys.pop((4, o_id), None)
+        self._start_primers(o_id, aln_fn)
+
+    def _start_primers(self, o_id, aln_fn):
+        if self._skip(5, o_id, steps.primers_key, aln_fn, self.settings['primers']):
+            return
+        # remove primer files of an earlier run
+        for fn in glob(os.path.join(self.primer_dir, os.path.basename(aln_fn) + '.*')):
+            os.remove(fn)
+        f = steps.copy_alignment(aln_fn, self.primer_dir, self.log_fh)
+        if f is None:
+            self.keys.pop((5, o_id), None)
+            return
+        # reuse cached primers if alignment, settings and PriFi are unchanged
+        if self.cache:
+            key = steps.primers_key(f, self.settings['primers'])
+            res = self.cache.load(key)
+            if res is not None:
+                self._write_primers(o_id, f, res)
+                return
+            self.primer_keys[o_id] = key
+        self._push('primers', o_id, steps.find_primers_in_file, (f, self.primer_config))
+
+    def _primers_done(self, o_id, result):
+        f = os.path.join(self.primer_dir, '%s.fasta' % o_id)
+        if o_id in self.primer_keys:
+            self.cache.save(self.primer_keys.pop(o_id), result)
+        self._write_primers(o_id, f, result)
+
+    def _write_primers(self, o_id, f, result):
+        primerpairs, output = result
+        steps.write_primers(f, primerpairs, output, self.log_fh)
+        self._record(5, o_id, steps.primer_outputs(f))
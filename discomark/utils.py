@@ -6,6 +6,8 @@ import os
 import re
 import shutil
 import sys
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from Bio import AlignIO
 from Bio.Seq import Seq
 
@@ -119,11 +121,44 @@ def csv_to_js(fn_in, fn_out, delim = ',', varname = 'data'):
             f_js.write(',\n')
         f_js.write("];\n")
 
-def purge_dir(path_to_dir):
+def purge_dir(path_to_dir, keep=()):
+    keep = set(os.path.abspath(f) for f in keep)
     for filename in os.listdir(path_to_dir):
         file_path = os.path.join(path_to_dir, filename)
         try:
-            if os.path.isfile(file_path):
+            if os.path.isfile(file_path) and os.path.abspath(file_path) not in keep:
                 os.unlink(file_path)
         except Exception as e:
             print(e, file=sys.stderr)
+
+def run_jobs(func, jobs, num_workers=1, costs=None, processes=False, initializer=None, initargs=()):
+    """Applies func to each job (a tuple of arguments) and yields the results
+    in job order. With more than one worker, jobs are run in a thread pool
+    (func is expected to spend its time in external processes) or, if
+    'processes' is set, in a process pool (for CPU-bound python code). Jobs
+    are started in order of decreasing cost, so that a single large job does
+    not end up running on its own at the end.
+    If given, initializer(*initargs) is called once in each worker.
+    """
+    if num_workers <= 1 or len(jobs) <= 1:
+        if initializer:
+            initializer(*initargs)
+        for job in jobs:
+            yield func(*job)
+        return
+
+    order = range(len(jobs))
+    if costs:
+        order = sorted(order, key=lambda i: costs[i], reverse=True)
+    pool_cls = Pool if processes else ThreadPool
+    pool = pool_cls(min(num_workers, len(jobs)), initializer, initargs)
+    try:
+        pending = {}
+        for i in order:
+            pending[i] = pool.apply_async(func, jobs[i])
+        pool.close()
+        for i in range(len(jobs)):
+            yield pending[i].get()
+    finally:
+        pool.terminate()
+        pool.join()
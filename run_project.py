@@ -3,9 +3,6 @@ from __future__ import division, print_function
 
 program = "DiscoMark"
 version = "1.0.1"
-# Run parameters
-# (todo: create command line params)
-num_threads = 1
 
 import argparse
 import datetime
@@ -17,7 +14,9 @@ try: # name of configparser module has been changed in Python3
     import configparser # python3
 except ImportError:
     import ConfigParser as configparser # python2
-from discomark import database, steps, utils
+from discomark import database, genome, steps, stream, utils
+from discomark.cache import StepCache
+from discomark.journal import StepJournal
 
 config = configparser.ConfigParser()
 config.optionxform = str
@@ -31,8 +30,12 @@ def parse_args():
     parser.add_argument('-r', '--reference', help="reference genome file (FASTA)")
     parser.add_argument('-s', '--step', help="start from step N", type=int, default=0)
     parser.add_argument('-a', '--annot', help="annotation file for input markers")
+    parser.add_argument('-t', '--threads', help="number of parallel threads (default: 1)", type=int, default=1)
     parser.add_argument('-v', '--verbose', help="increase output verbosity", action='store_true')
     parser.add_argument('--no-trim', help="skip alignment trimming step", action='store_true')
+    parser.add_argument('--map-mode', help="sequences mapped against the reference: all aligned sequences, or one consensus/longest sequence per alignment (default: all)", choices=steps.MAP_MODES, default='all')
+    parser.add_argument('--ref-mode', help="how to include the reference in ortholog alignments: realign all sequences, or add it to the existing alignment with MAFFT --add/--addfragments (default: realign)", choices=steps.REF_MODES, default='realign')
+    parser.add_argument('--stream', help="pass each ortholog on to the next step as soon as it is ready, instead of running steps 1-5 one after the other", action='store_true')
     parser.add_argument('--no-primer-blast', help="skip online primer BLAST (use, when running without internet connection", action='store_true')
     args = parser.parse_args()
 
@@ -60,6 +63,11 @@ def parse_args():
         if not os.path.isfile(args.reference):
             utils.print_error_and_exit("reference genome '%s' does not exist or is not a regular file" % args.reference)
 
+    if args.threads < 1:
+        utils.print_error_and_exit("number of threads must be at least 1")
+    if args.stream and args.step > 1:
+        utils.print_error_and_exit("streaming mode runs steps 1-5 together, it can only be resumed from step 0 or 1")
+
     return args
 
 if __name__ == '__main__':
@@ -77,6 +85,8 @@ if __name__ == '__main__':
     primer_dir  = os.path.join(args.dir, config.get('Data', 'primer_dir'))
     blast_dir   = os.path.join(args.dir, config.get('Data', 'blast_dir'))
     report_dir  = os.path.join(args.dir, config.get('Data', 'report_dir'))
+    # BLAST database and FASTA index of the reference are shared between runs
+    genome_cache = genome.open_cache(config)
 
     if args.step <= 0:
         if not os.path.exists(args.dir):
@@ -99,44 +109,62 @@ if __name__ == '__main__':
             do_ref_map = True
 
 
+    # outputs of steps 2-5 are reused for unchanged orthologs
+    step_cache = None
+    if config.has_option('Data', 'step_cache_dir'):
+        cache_size = config.getint('Data', 'step_cache_size') if config.has_option('Data', 'step_cache_size') else 1024
+        step_cache = StepCache(os.path.join(args.dir, os.path.expanduser(config.get('Data', 'step_cache_dir'))), cache_size * 1024**2)
+
     # 1. parse predicted orthologs
     if args.step <= 0:
-        model.create_db_from_input(input_dir)
+        model.create_db_from_input(input_dir, num_procs=args.threads)
     orthologs = model.get_orthologs()
-    if args.step <= 1:
+    if args.stream:
+        print("\n[1-5] Processing orthologs from input folders to primers...")
+        journals = dict((step, StepJournal(model, step, d)) for step, d in
+                        ((2, aligned_dir), (3, trimmed_dir), (4, mapped_dir), (5, primer_dir)))
+        pipeline = stream.StreamingPipeline(args.dir, model, config, logfile, args.threads, do_ref_map,
+                                            args.map_mode, args.ref_mode, not args.no_trim, step_cache, journals)
+        pipeline.run(orthologs)
+    if args.step <= 1 and not args.stream:
         print("\n[1] Combining orthologs from input folders...")
         steps.merge_species(input_dir, ortho_dir, orthologs, logfile)
     # 2. align ortholog files
-    if args.step <= 2:
+    if args.step <= 2 and not args.stream:
         print("\n[2] Aligning orthologous sequences...")
         settings = config.items('02_MAFFT_settings')
-        steps.align_orthologs(ortho_dir, aligned_dir, orthologs, settings, logfile)
+        steps.align_orthologs(ortho_dir, aligned_dir, orthologs, settings, logfile, args.threads, step_cache,
+                              StepJournal(model, 2, aligned_dir))
     # 3. trim alignments
-    if args.step <= 3 and not args.no_trim:
+    if args.step <= 3 and not args.no_trim and not args.stream:
         print("\n[3] Trimming alignments...")
         settings = config.items('03_TrimAl_settings')
-        steps.trim_alignments(aligned_dir, trimmed_dir, settings, logfile)
+        steps.trim_alignments(aligned_dir, trimmed_dir, settings, logfile, args.threads, step_cache,
+                              StepJournal(model, 3, trimmed_dir))
     # 4. map trimmed alignments against reference genome
-    if args.step <= 4:
+    if args.step <= 4 and not args.stream:
         print("\n[4] Mapping alignments to reference...")
         if do_ref_map:
             source_dir = aligned_dir
             settings = config.items('04_BLAST_settings')
-            out_fn = steps.map_to_reference(source_dir, mapped_dir, reference, settings, logfile)
-            model.load_blast_hits(out_fn)
+            out_fn = steps.map_to_reference(source_dir, mapped_dir, reference, settings, logfile, args.threads, genome_cache, args.map_mode)
+            model.load_blast_hits(out_fn, per_ortholog=(args.map_mode != 'all'))
             hits = model.get_best_hits()
             model.update_uniq_ref_flag()
             settings = config.items('04_MAFFT_settings')
-            steps.add_reference(source_dir, mapped_dir, reference, hits, settings, logfile)
+            steps.add_reference(source_dir, mapped_dir, reference, hits, settings, logfile, args.threads, args.ref_mode, genome_cache, step_cache,
+                                StepJournal(model, 4, mapped_dir))
         else:
             print("\t-> no reference genome provided -> skipping this step...")
 
     # 5. design primers
     if args.step <= 5:
-        print("\n[5] Designing primers based on multiple alignments...")
-        settings = config.items('05_PriFi_settings')
-        source_dir = mapped_dir if do_ref_map else (trimmed_dir if not args.no_trim else aligned_dir)
-        steps.design_primers(source_dir, primer_dir, settings, logfile)
+        if not args.stream:
+            print("\n[5] Designing primers based on multiple alignments...")
+            settings = config.items('05_PriFi_settings')
+            source_dir = mapped_dir if do_ref_map else (trimmed_dir if not args.no_trim else aligned_dir)
+            steps.design_primers(source_dir, primer_dir, settings, logfile, args.threads, step_cache,
+                                 StepJournal(model, 5, primer_dir))
         model.load_primers(primer_dir)
         model.export_primers_to_file(os.path.join(primer_dir, 'primers.fa'))
         orthologs = model.get_orthologs()
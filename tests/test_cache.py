@@ -0,0 +1,88 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from discomark.cache import StepCache
+
+
+class StepCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = StepCache(os.path.join(self.tmp_dir, 'cache'), max_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        fn = os.path.join(self.tmp_dir, name)
+        with open(fn, 'wt') as f:
+            f.write(data)
+        return fn
+
+    def read(self, fn):
+        with open(fn, 'rt') as f:
+            return f.read()
+
+    def test_key(self):
+        fn = self.write('in.fasta', '>a\nACGT\n')
+        key = StepCache.key('align', 'v7', ('file', fn))
+        self.assertEqual(key, StepCache.key('align', 'v7', ('file', fn)))
+        self.assertNotEqual(key, StepCache.key('align', 'v8', ('file', fn)))
+        self.write('in.fasta', '>a\nACGA\n')
+        self.assertNotEqual(key, StepCache.key('align', 'v7', ('file', fn)))
+
+    def test_store_fetch(self):
+        fns = [self.write('out.fasta', 'ACGT'), self.write('out.html', '<html/>')]
+        key = StepCache.key('trim', 'x')
+        self.cache.store(key, fns)
+        self.assertEqual(self.cache.size, 11)
+
+        out_fns = [os.path.join(self.tmp_dir, 'copy.fasta'), os.path.join(self.tmp_dir, 'copy.html')]
+        self.assertTrue(self.cache.fetch(key, out_fns))
+        self.assertEqual([self.read(fn) for fn in out_fns], ['ACGT', '<html/>'])
+        self.assertFalse(self.cache.fetch(StepCache.key('trim', 'y'), out_fns))
+
+    def test_save_load(self):
+        key = StepCache.key('primers', 'x')
+        self.assertEqual(self.cache.load(key), None)
+        self.cache.save(key, {'413058': [1, 2]})
+        self.assertEqual(self.cache.load(key), {'413058': [1, 2]})
+
+    def test_evict(self):
+        keys = [StepCache.key('align', i) for i in range(4)]
+        for i, key in enumerate(keys):
+            self.cache.store(key, [self.write('out.fasta', str(i) * 400)])
+            # entries are ordered by modification time of their folder
+            os.utime(self.cache._path(key), (i, i))
+        self.assertTrue(self.cache.size <= 900)
+        out_fns = [os.path.join(self.tmp_dir, 'copy.fasta')]
+        self.assertFalse(self.cache.fetch(keys[0], out_fns))
+        self.assertFalse(self.cache.fetch(keys[1], out_fns))
+        self.assertTrue(self.cache.fetch(keys[3], out_fns))
+        self.assertEqual(self.read(out_fns[0]), '3' * 400)
+
+    def test_fetch_after_evict(self):
+        key = StepCache.key('align', 'x')
+        self.cache.store(key, [self.write('out.fasta', 'ACGT')])
+        self.cache.max_size = 0
+        self.cache.evict()
+        out_fn = os.path.join(self.tmp_dir, 'copy.fasta')
+        self.assertFalse(self.cache.fetch(key, [out_fn]))
+        self.assertFalse(os.path.exists(out_fn))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_truncated_pickle(self):
+        key = StepCache.key('primers', 'x')
+        self.cache.save(key, list(range(100)))
+        fn = os.path.join(self.cache._path(key), 'pickle')
+        with open(fn, 'rb') as f:
+            data = f.read()
+        with open(fn, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertEqual(self.cache.load(key), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from Bio import SeqIO
+from discomark.genome import FastaIndex
+
+
+class FastaIndexTest(unittest.TestCase):
+
+    seqs = [('chr1', 'ACGTACGTAC' * 7 + 'GGT'), ('chr2', 'TTGCA' * 12), ('chr3', 'A')]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, width, newline='\n'):
+        fn = os.path.join(self.tmp_dir, name)
+        with open(fn, 'wb') as f:
+            for seq_id, seq in self.seqs:
+                lines = [seq[i:i+width] for i in range(0, len(seq), width)] if width else [seq]
+                f.write(('>%s test sequence%s' % (seq_id, newline)).encode('ascii'))
+                f.write(''.join([line + newline for line in lines]).encode('ascii'))
+        return fn
+
+    def check(self, fn, width):
+        fai = FastaIndex(fn)
+        try:
+            records = SeqIO.to_dict(SeqIO.parse(fn, 'fasta'))
+            self.assertEqual(fai.names, [seq_id for seq_id, _ in self.seqs])
+            for seq_id, rec in records.items():
+                seq = str(rec.seq)
+                n = len(seq)
+                self.assertEqual(fai.length(seq_id), n)
+                self.assertEqual(fai.description(seq_id), rec.description)
+                # slices starting and ending at line breaks and the sequence end
+                bounds = set([0, 1, n - 1, n, n + 5])
+                if width:
+                    for i in range(width, n, width):
+                        bounds.update([i - 1, i, i + 1])
+                for start in bounds:
+                    for end in bounds:
+                        self.assertEqual(fai.fetch(seq_id, start, end), seq[start:end], (seq_id, start, end))
+        finally:
+            fai.close()
+
+    def test_wrapped(self):
+        self.check(self.write('wrapped.fasta', 10), 10)
+
+    def test_unwrapped(self):
+        self.check(self.write('unwrapped.fasta', 0), 0)
+
+    def test_crlf(self):
+        self.check(self.write('crlf.fasta', 7, '\r\n'), 7)
+
+    def test_index_file(self):
+        fn = self.write('wrapped.fasta', 10)
+        fai = FastaIndex(fn)
+        fai.close()
+        self.assertTrue(os.path.exists(fn + '.fai'))
+        self.assertEqual(FastaIndex.read_index(fn + '.fai'), fai.entries)
+
+    def test_irregular_lines(self):
+        fn = os.path.join(self.tmp_dir, 'irregular.fasta')
+        with open(fn, 'wt') as f:
+            f.write('>chr1\nACGTACGT\nACG\nACGTACGT\n')
+        self.assertRaises(ValueError, FastaIndex, fn)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from discomark import database
+from discomark.journal import StepJournal
+
+
+class StepJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(self.tmp_dir, '3_trimmed_alignments')
+        os.mkdir(self.out_dir)
+        self.model = database.DataBroker(self.tmp_dir)
+        self.model.create_schema()
+        self.fns = [self.write('413058.fasta', '>a\nACGT\n'), self.write('413058.fasta.html', '<html/>')]
+        StepJournal(self.model, 3, self.out_dir).record('413058', 'key1', self.fns)
+
+    def tearDown(self):
+        self.model.session.close()
+        self.model.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        fn = os.path.join(self.out_dir, name)
+        with open(fn, 'wt') as f:
+            f.write(data)
+        return fn
+
+    def test_skip(self):
+        journal = StepJournal(self.model, 3, self.out_dir)
+        self.assertEqual(journal.outputs('413058'), self.fns)
+        self.assertTrue(journal.done('413058', 'key1'))
+        self.assertEqual(journal.skipped, 1)
+        # other steps and orthologs have no checkpoints
+        self.assertFalse(StepJournal(self.model, 2, self.out_dir).done('413058', 'key1'))
+        self.assertFalse(journal.done('412884', 'key1'))
+
+    def test_changed_input(self):
+        self.assertFalse(StepJournal(self.model, 3, self.out_dir).done('413058', 'key2'))
+
+    def test_changed_output(self):
+        self.write('413058.fasta.html', '<html></html>')
+        journal = StepJournal(self.model, 3, self.out_dir)
+        self.assertFalse(journal.done('413058', 'key1'))
+        self.assertEqual(journal.skipped, 0)
+
+    def test_deleted_output(self):
+        os.remove(self.fns[0])
+        self.assertFalse(StepJournal(self.model, 3, self.out_dir).done('413058', 'key1'))
+
+    def test_record_again(self):
+        self.write('413058.fasta', '>a\nACGA\n')
+        StepJournal(self.model, 3, self.out_dir).record('413058', 'key2', self.fns)
+        journal = StepJournal(self.model, 3, self.out_dir)
+        self.assertEqual(len(journal.entries), 1)
+        self.assertFalse(journal.done('413058', 'key1'))
+        self.assertTrue(journal.done('413058', 'key2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Benchmark for the DiscoMark database layer.
+
+Builds a synthetic project database (species, orthologs, sequences,
+annotations, BLAST hits and primer sets) twice, once without the secondary
+indexes and SQLite settings of DataBroker and once with them, and reports
+the time taken by load_blast_hits, get_best_hits and the report queries.
+
+Usage: python util/benchmark_db.py [-s SPECIES] [-n ORTHOLOGS]
+"""
+
+from __future__ import division, print_function
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from discomark.database import DataBroker
+from discomark.models import *
+
+
+def populate(db, n_species, n_orthologs, rnd):
+    session = db.get_session()
+    tab = lambda model: model.__table__
+
+    session.execute(tab(Species).insert(), [{'id': i+1, 'name': 'species%d' % (i+1)} for i in range(n_species)])
+    session.execute(tab(Ortholog).insert(), [{'id': str(100000+o)} for o in range(n_orthologs)])
+    session.execute(tab(Category).insert(), [{'id': c+1, 'name': 'category%d' % c} for c in range(5)])
+    session.execute(tab(Function).insert(), [{'id': f+1, 'id_category': f%5+1, 'shortcode': 'GO:%07d' % f, 'description': ''}
+                                             for f in range(50)])
+    session.execute(fun_orto.insert(), [{'id_function': rnd.randint(1, 50), 'id_ortholog': str(100000+o)}
+                                        for o in range(n_orthologs) for _ in range(2)])
+    seqs = []
+    for s in range(n_species):
+        for o in range(n_orthologs):
+            seq_id = len(seqs) + 1
+            seqs.append({'id': seq_id, 'id_species': s+1, 'id_ortholog': str(100000+o),
+                         'fasta_id': 'sp%d_%d' % (s+1, o), 'residues': 'ACGT' * 100,
+                         'description': 'id=%d,id_species=%d' % (seq_id, s+1)})
+    session.execute(tab(Sequence).insert(), seqs)
+    session.commit()
+    return seqs
+
+
+def write_blast_hits(fn, seqs, n_orthologs, rnd):
+    # tabular BLAST output, 1-3 HSPs per query
+    # (qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore sstrand)
+    with open(fn, 'wt') as f:
+        for seq in seqs:
+            o = int(seq['id_ortholog']) - 100000
+            ref = 'chr%d' % (o % 20 if rnd.random() < 0.9 else rnd.randint(0, 19))
+            pos = (o * 5000) % 10000000
+            strand = 'plus' if o % 2 else 'minus'
+            for h in range(rnd.randint(1, 3)):
+                start = pos + rnd.randint(0, 300)
+                length = rnd.randint(50, 400)
+                s, e = (start, start+length) if strand == 'plus' else (start+length, start)
+                f.write('%s\t%s\t98.0\t%d\t1\t0\t1\t%d\t%d\t%d\t1e-50\t300\t%s\n'
+                        % (seq['fasta_id'], ref, length, length, s, e, strand))
+
+
+def add_primer_sets(db, n_orthologs, rnd):
+    session = db.get_session()
+    rows = []
+    for o in range(0, n_orthologs, 3):
+        for i in range(3):
+            rows.append({'id_ortholog': str(100000+o), 'ps_idx': i+1, 'prod_len': rnd.randint(200, 1000),
+                         'pos_fw': '10-30', 'pos_rv': '500-520', 'seq_fw': 'ACGT'*5, 'seq_rv': 'TGCA'*5,
+                         'tm_fw': 55.0, 'tm_rv': 56.0, 'num_species': rnd.randint(1, 4), 'num_snps': 3})
+    session.execute(PrimerSet.__table__.insert(), rows)
+    session.commit()
+
+
+def run(project_dir, tuned, n_species, n_orthologs):
+    rnd = random.Random(1)
+    db = DataBroker(project_dir, tuned=tuned)
+    db.create_schema()
+    if not tuned:
+        for tab in Base.metadata.sorted_tables:
+            for idx in tab.indexes:
+                idx.drop(db.engine)
+
+    seqs = populate(db, n_species, n_orthologs, rnd)
+    blast_fn = os.path.join(project_dir, 'blast.out')
+    write_blast_hits(blast_fn, seqs, n_orthologs, rnd)
+
+    timings = []
+    def timed(name, func, *args):
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'wt') # report functions print file names
+        t = time.time()
+        try:
+            func(*args)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        timings.append((name, time.time() - t))
+
+    timed('load_blast_hits', db.load_blast_hits, blast_fn)
+    timed('get_best_hits', db.get_best_hits)
+    add_primer_sets(db, n_orthologs, rnd)
+    timed('update_uniq_ref_flag', db.update_uniq_ref_flag)
+    timed('primersets_to_csv', db.primersets_to_csv, os.path.join(project_dir, 'primers.csv'))
+    timed('generateSummaryJs', db.generateSummaryJs, os.path.join(project_dir, 'summary.js'))
+    timed('generateCountsJs', db.generateCountsJs, os.path.join(project_dir, 'counts.js'))
+    db.get_session().close()
+    db.engine.dispose()
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark DiscoMark database operations.')
+    parser.add_argument('-s', '--species', type=int, default=4, help="number of species (default: 4)")
+    parser.add_argument('-n', '--orthologs', type=int, default=2000, help="number of orthologs (default: 2000)")
+    args = parser.parse_args()
+
+    results = {}
+    for tuned in (False, True):
+        project_dir = tempfile.mkdtemp(prefix='discomark_bench_')
+        try:
+            results[tuned] = run(project_dir, tuned, args.species, args.orthologs)
+        finally:
+            shutil.rmtree(project_dir)
+
+    print("%d species, %d orthologs\n" % (args.species, args.orthologs))
+    print("%-22s %10s %10s" % ('', 'plain [s]', 'tuned [s]'))
+    for (name, t_plain), (_, t_tuned) in zip(results[False], results[True]):
+        print("%-22s %10.3f %10.3f" % (name, t_plain, t_tuned))
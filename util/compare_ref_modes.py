@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compare the ways of including the reference genome in ortholog alignments.
+
+Takes a DiscoMark output folder in which step 4 (reference mapping) has been
+run, adds the reference slices to the step 2 alignments once by realigning
+all sequences and once with MAFFT's --add/--addfragments, designs primers on
+both sets of alignments and reports the time taken and the differences
+between the resulting primer sets.
+
+Usage: python util/compare_ref_modes.py -d OUTPUT_DIR [-m MODE] [-t THREADS]
+"""
+
+from __future__ import division, print_function
+import argparse
+from glob import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+try: # name of configparser module has been changed in Python3
+    import configparser # python3
+except ImportError:
+    import ConfigParser as configparser # python2
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root_dir)
+from discomark import database, genome, steps, utils
+import prifipy
+
+
+def primer_sets(aln_dir, settings, num_threads):
+    # primer pairs (fw, rv) suggested for each alignment
+    config = prifipy.PrimerDesignConfig(settings)
+    jobs = [(f, config) for f in sorted(glob(os.path.join(aln_dir, '*.fasta')))]
+    costs = [os.path.getsize(f) for (f, _) in jobs]
+    results = utils.run_jobs(steps.find_primers_in_file, jobs, num_threads, costs, processes=True)
+    primers = {}
+    for (f, _), (primerpairs, _) in zip(jobs, results):
+        if primerpairs:
+            o_id = os.path.basename(f).split('.')[0]
+            primers[o_id] = [(p1, p2) for (p1, p2, _) in primerpairs]
+    return primers
+
+
+def run(project_dir, mode, work_dir, config, num_threads):
+    aligned_dir = os.path.join(project_dir, config.get('Data', 'aligned_dir'))
+    reference = os.path.join(project_dir, config.get('Data', 'reference_dir'), 'genome.fasta')
+    hits = database.DataBroker(project_dir).get_best_hits()
+    genome_cache = genome.open_cache(config)
+
+    target_dir = os.path.join(work_dir, mode)
+    os.mkdir(target_dir)
+    with open(os.path.join(work_dir, '%s.log' % mode), 'wt') as log_fh:
+        t = time.time()
+        steps.add_reference(aligned_dir, target_dir, reference, hits, config.items('04_MAFFT_settings'),
+                            log_fh, num_threads, mode, genome_cache)
+        t_align = time.time() - t
+    t = time.time()
+    primers = primer_sets(target_dir, config.items('05_PriFi_settings'), num_threads)
+    t_primers = time.time() - t
+    return primers, t_align, t_primers
+
+
+def compare(primers_a, primers_b):
+    counts = {'same': 0, 'shared': 0, 'different': 0, 'only_a': 0, 'only_b': 0}
+    for o_id in set(primers_a) | set(primers_b):
+        if o_id not in primers_b:
+            counts['only_a'] += 1
+        elif o_id not in primers_a:
+            counts['only_b'] += 1
+        elif primers_a[o_id] == primers_b[o_id]:
+            counts['same'] += 1
+        elif set(primers_a[o_id]) & set(primers_b[o_id]):
+            counts['shared'] += 1
+        else:
+            counts['different'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare primer sets designed on realigned vs. reference-added alignments.')
+    parser.add_argument('-d', '--dir', required=True, help="DiscoMark output folder (step 4 completed)")
+    parser.add_argument('-m', '--mode', choices=steps.REF_MODES[1:], default='add', help="MAFFT mode to compare with full realignment (default: add)")
+    parser.add_argument('-t', '--threads', type=int, default=1, help="number of parallel threads (default: 1)")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(root_dir, 'discomark.conf'))
+
+    work_dir = tempfile.mkdtemp(prefix='discomark_refmodes_')
+    try:
+        results = {}
+        for mode in ('realign', args.mode):
+            results[mode] = run(args.dir, mode, work_dir, config, args.threads)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("%-14s %12s %12s %12s" % ('', 'align [s]', 'primers [s]', 'orthologs'))
+    for mode in ('realign', args.mode):
+        primers, t_align, t_primers = results[mode]
+        print("%-14s %12.1f %12.1f %12d" % (mode, t_align, t_primers, len(primers)))
+
+    counts = compare(results['realign'][0], results[args.mode][0])
+    print("\nOrthologs with primers")
+    print("  %-30s %d" % ('identical primer sets:', counts['same']))
+    print("  %-30s %d" % ('some primer pairs in common:', counts['shared']))
+    print("  %-30s %d" % ('no primer pairs in common:', counts['different']))
+    print("  %-30s %d" % ("only with 'realign':", counts['only_a']))
+    print("  %-30s %d" % ("only with '%s':" % args.mode, counts['only_b']))
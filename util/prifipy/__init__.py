@@ -2,8 +2,10 @@ import sys
 
 import prifipy.config as config
 from .config import *
-from .alignment import columnsummary
+from .config import PrimerDesignConfig
+from .alignment import AlignmentMatrix, columnsummary
 #from .config import *
-from .meltingtemperature import Tm
+from .meltingtemperature import Tm, TmWindows
+from . import iupac
 from .primerfinder_ver2 import findprimers, writePrimersToFiles
 from .reversecomplement import reverse_and_complement
@@ -8,7 +8,9 @@ import sys
 from Bio.Align.Applications import ClustalwCommandline
 from Bio.Align import AlignInfo
 from Bio import AlignIO
+import numpy as np
 import prifipy.config as cf
+from prifipy.iupac import COLUMNMASKS
 
 
 
@@ -41,6 +43,95 @@ def columnsummary( col ):
 
 
 
+class AlignmentMatrix:
+    """holds a multiple alignment as a (#sequences x alignment length) numpy
+    array of uint8 character codes. Summary information for all columns is
+    computed at once using vectorized operations."""
+
+    GAP = ord('-')
+
+    def __init__( self, seqs ):
+        """seqs is a list of aligned sequences given as strings or as
+        Biopython SeqRecords (e.g. a Bio.Align.MultipleSeqAlignment)."""
+        self.ids = []
+        rows = []
+        for s in seqs:
+            if hasattr(s, 'seq'):
+                self.ids.append(s.id)
+                s = str(s.seq)
+            else:
+                self.ids.append('')
+            rows.append(s if isinstance(s, bytes) else s.encode('ascii'))
+
+        self.length = len(rows[0]) if rows else 0
+        self.data = np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(len(rows), self.length)
+
+    def __len__( self ):
+        return self.data.shape[0]
+
+    def get_alignment_length( self ):
+        return self.length
+
+    def column( self, i ):
+        """returns column i as a string"""
+        return self.data[:,i].tobytes().decode('ascii')
+
+    def columnmasks( self, cols ):
+        """returns the IUPAC column masks (see iupac.py) of the given list
+        of columns"""
+        return np.bitwise_or.reduce(COLUMNMASKS[self.data[:,cols]], axis=0).tolist()
+
+    def count( self, c, s, e ):
+        """returns an array holding the number of occurrences of character c
+        in columns [s, e[ of each sequence"""
+        return (self.data[:,s:e] == ord(c)).sum(axis=1)
+
+    def has_chars( self, chars ):
+        """returns a boolean array, True for columns containing any of the
+        given characters"""
+        flags = np.zeros(self.length, dtype=bool)
+        for c in chars:
+            flags |= (self.data == ord(c)).any(axis=0)
+        return flags
+
+    def intron_columns( self ):
+        """columns holding an intron marker (X) in at least one sequence"""
+        return self.has_chars('Xx')
+
+    def template( self ):
+        """returns the alignment collapsed to a single string: each column
+        is represented by the symbol of the first sequence that does not
+        have a gap there ('C' for all-gap columns)."""
+        nongap = self.data != self.GAP
+        first = nongap.argmax(axis=0)
+        t = self.data[first, np.arange(self.length)]
+        t[~nongap.any(axis=0)] = ord('C')
+        return t.tobytes().decode('ascii')
+
+    def columnsummaries( self ):
+        """vectorized version of columnsummary(): returns two arrays holding
+        the number of different nucleotides and the total number of
+        nucleotides for each column. Columns with X's or N's get (1, 0)."""
+        if len(self) == 0:
+            return (np.zeros(self.length, dtype=int), np.zeros(self.length, dtype=int))
+
+        gaps = (self.data == self.GAP)
+        total = len(self) - gaps.sum(axis=0)
+
+        # count distinct symbols in each column, then don't count the gap:
+        srt = np.sort(self.data, axis=0)
+        diff = (srt[1:] != srt[:-1]).sum(axis=0) + 1
+        diff -= gaps.any(axis=0)
+
+        masked = self.has_chars('XxNn')
+        diff[masked] = 1
+        total[masked] = 0
+
+        return (diff.astype(int), total.astype(int))
+
+
+
+
 def printslice( allseq, s, e ):
     """prints a slice of the given alignment (given as a list of strings), including consensus *'s"""
     # here's how the list of sequences might be retrieved:
@@ -1,3 +1,5 @@
+import ast
+import copy
 from os.path import exists
 from sys import modules
 thismodule = modules[__name__] # a handle to this module
@@ -156,66 +158,130 @@ def trueLengthOfIntronWithMarkerLength( markerlength ):
 #
 
 INF = -99999999
-if MaxMismatches > 0:
-    #
-    # the penalties below are probably too restrictive in that they hinder
-    # any region which starts with e.g. ****-, where * is perfect match and
-    # - is a mismatch, no matter what comes after. That is not good since e.g.
-    # ****-******************** might be better than just the last part starting
-    # after the mismatch.
-    #
-    # p1 = MaxPrimerLength / MaxMismatches
-    # p2 = ( MaxPrimerLength / MaxMismatchesWithMaxDiversity ) - 2
-    #
-    # so use these instead for region identification (note that bad primers
-    # are reeped out later anyway):
-    #
-    p1 = 2  # at most every second column can be a mismatch with 2 diff. nucs.
-    p2 = 2
-    p3 = 2
-    #
-else:
-    p1 = INF
-    p2 = INF
-    p3 = INF
-
-# columns with more than one sequence represented and only one nucleotide
-# (perfect alignment) are rewarded; others are penalized. Some with
-# -infinity if this column should never be part of any primer, some with
-# lesser numbers if they might participate in a primer site.
-
-#total #nucs:     0    1    2    3    4    5    6    7    8    9   10   11   12   13   14   15   16   17   18   19   20   21   22   23      in alignment column.
-scorematrix = ( [INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF], # 0 different nucleotides
-                [INF, INF,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1], # 1 different nucleotides
-                [INF, INF, -p3, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1], # 2 different nucleotides
-                [INF, INF, INF, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2], # 3 different nucleotides
-                [INF, INF, INF, INF, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2], # 4 different nucleotides
-                [INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF]) # 5 different nucleotides
-
-# scorematrix = ( [INF, INF, INF, INF, INF, INF], # 0 different nucleotides
-#                 [INF, INF,   1,   1,   1,   1], # 1 different nucleotides
-#                 [INF, INF, -p3, -p1, -p1, -p1], # 2 different nucleotides
-#                 [INF, INF, INF, -p2, -p2, -p2], # 3 different nucleotides
-#                 [INF, INF, INF, INF, -p2, -p2], # 4 different nucleotides
-#                 [INF, INF, INF, INF, INF, INF]) # 5 different nucleotides
-
-# (NB: the following note no longer holds, the entry has been corrected from
-# INF to -p3)
-# Note that it is disallowed to have 2 nucleotides in total that are different
-
-# NB: entry (1, 0) - 0 nucleotides in total, 1 different, which of course
-# is impossible - is used to hold the penalty for a column which has an X
-# or N in it, i.e. is an intron in one of the sequences. Such a column may not
-# be part of a primer region, so we need to be able to score it with -infinity.
-
-
-
-# No alignment columns with too few nucleotides may be included, change any entries
-# in the scorematrix that otherwise might allow that to happen:
-for tuple in scorematrix:
-    for j in range( 1, MinNucleotidesPerColumn ):# entry 0 assumed to be INF a priori
-        tuple[j] = INF
 
+def scoreMatrix( maxmismatches, minnucleotidespercolumn ):
+    """return the score matrix for the given MaxMismatches and
+    MinNucleotidesPerColumn values, along with the mismatch penalties p1, p2
+    and p3 used in it."""
+
+    if maxmismatches > 0:
+        #
+        # the penalties below are probably too restrictive in that they hinder
+        # any region which starts with e.g. ****-, where * is perfect match and
+        # - is a mismatch, no matter what comes after. That is not good since e.g.
+        # ****-******************** might be better than just the last part starting
+        # after the mismatch.
+        #
+        # p1 = MaxPrimerLength / MaxMismatches
+        # p2 = ( MaxPrimerLength / MaxMismatchesWithMaxDiversity ) - 2
+        #
+        # so use these instead for region identification (note that bad primers
+        # are reeped out later anyway):
+        #
+        p1 = 2  # at most every second column can be a mismatch with 2 diff. nucs.
+        p2 = 2
+        p3 = 2
+        #
+    else:
+        p1 = INF
+        p2 = INF
+        p3 = INF
+
+    # columns with more than one sequence represented and only one nucleotide
+    # (perfect alignment) are rewarded; others are penalized. Some with
+    # -infinity if this column should never be part of any primer, some with
+    # lesser numbers if they might participate in a primer site.
+
+    #total #nucs:     0    1    2    3    4    5    6    7    8    9   10   11   12   13   14   15   16   17   18   19   20   21   22   23      in alignment column.
+    scorematrix = ( [INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF], # 0 different nucleotides
+                    [INF, INF,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1,   1], # 1 different nucleotides
+                    [INF, INF, -p3, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1, -p1], # 2 different nucleotides
+                    [INF, INF, INF, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2], # 3 different nucleotides
+                    [INF, INF, INF, INF, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2, -p2], # 4 different nucleotides
+                    [INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF, INF]) # 5 different nucleotides
+
+    # scorematrix = ( [INF, INF, INF, INF, INF, INF], # 0 different nucleotides
+    #                 [INF, INF,   1,   1,   1,   1], # 1 different nucleotides
+    #                 [INF, INF, -p3, -p1, -p1, -p1], # 2 different nucleotides
+    #                 [INF, INF, INF, -p2, -p2, -p2], # 3 different nucleotides
+    #                 [INF, INF, INF, INF, -p2, -p2], # 4 different nucleotides
+    #                 [INF, INF, INF, INF, INF, INF]) # 5 different nucleotides
+
+    # (NB: the following note no longer holds, the entry has been corrected from
+    # INF to -p3)
+    # Note that it is disallowed to have 2 nucleotides in total that are different
+
+    # NB: entry (1, 0) - 0 nucleotides in total, 1 different, which of course
+    # is impossible - is used to hold the penalty for a column which has an X
+    # or N in it, i.e. is an intron in one of the sequences. Such a column may not
+    # be part of a primer region, so we need to be able to score it with -infinity.
+
+
+
+    # No alignment columns with too few nucleotides may be included, change any entries
+    # in the scorematrix that otherwise might allow that to happen:
+    for tuple in scorematrix:
+        for j in range( 1, minnucleotidespercolumn ):# entry 0 assumed to be INF a priori
+            tuple[j] = INF
+
+    return scorematrix, p1, p2, p3
+
+scorematrix, p1, p2, p3 = scoreMatrix( MaxMismatches, MinNucleotidesPerColumn )
+
+
+
+
+
+# names of the parameters used in primer design (copied into each
+# PrimerDesignConfig):
+DesignParameters = [ 'INTRONS', 'MatchOverlap', 'PrimerPairSuggestions', 'TailLength',
+                     'MaxPrimerLength', 'MinPrimerLength', 'SuggestedMaxTm', 'MinTm',
+                     'CriticalTm', 'MinTmWithMismatchesAllowed', 'Min3endPerfectMatches',
+                     'MaxMismatches', 'MinLengthWithThreeAmbiguities',
+                     'MinLengthWithTwoAmbiguities', 'WindowWithFourMismatches',
+                     'CriticalAmbiguityDistanceTo3End', 'MaxDiversityPerColumn',
+                     'MaxMismatchesWithMaxDiversity', 'MinNucleotidesPerColumn',
+                     'PrimerConcentrationNmolar', 'SaltConcentrationMolar',
+                     'MaxPrimerPairTmDifference', 'OptimalPrimerLength',
+                     'OptimalProductLength', 'OptimalProductLengthReward',
+                     'MinProductLength', 'MaxProductLength',
+                     'OptimalPrimerLengthDispensationWithNoMismatches',
+                     'GoodConservedRegionLength', 'MinPreIntronLength',
+                     'OptimalPreIntronLength', 'MinDistanceToIntron', 'ConservationWindow',
+                     'NonConservationPenalty', 'MinConservationPercent' ]
+
+
+
+class PrimerDesignConfig:
+    """holds the parameters for one primer design run. The parameters start
+    out with the values of the module variables above, settings is a list of
+    (parameter name, value string) pairs, e.g. the items of a config file
+    section, whose values are parsed as python literals. The score matrix and
+    the melting temperature model are derived from the parameters of the
+    object, so several configurations can be used side by side (e.g. in
+    different threads) without touching the module variables."""
+
+    INF = INF
+
+    def __init__( self, settings=() ):
+        for name in DesignParameters:
+            setattr( self, name, copy.deepcopy( getattr( thismodule, name ) ) )
+        self.apply( settings )
+
+
+    def apply( self, settings ):
+        """assign the given (parameter name, value string) pairs and derive
+        the score matrix and melting temperature model again"""
+        for key, val in settings:
+            getattr( self, key ) # unknown parameter names raise AttributeError
+            setattr( self, key, ast.literal_eval( val ) )
+
+        self.scorematrix, self.p1, self.p2, self.p3 = scoreMatrix( self.MaxMismatches, self.MinNucleotidesPerColumn )
+        self.TM = Tm( self.PrimerConcentrationNmolar, self.SaltConcentrationMolar )
+
+
+    def trueLengthOfIntronWithMarkerLength( self, markerlength ):
+        return trueLengthOfIntronWithMarkerLength( markerlength )
 
 
 
@@ -0,0 +1,73 @@
+"""Nucleotides and IUPAC ambiguity codes as 4-bit masks.
+
+Each code is the set of nucleotides it stands for, with A=1, C=2, G=4 and
+T=8 (e.g. R = A|G = 5, N = 15), so merging codes is a bitwise OR and taking
+the complement is a reversal of the four bits. Strings are converted with
+translate tables at the edges."""
+
+import numpy as np
+
+try:
+    maketrans = str.maketrans # python 3
+except AttributeError:
+    from string import maketrans # python 2
+
+A, C, G, T = 1, 2, 4, 8
+
+# code letter for each mask (mask 0 is a gap):
+CODES = '-ACMGRSVTWYHKDBN'
+
+MASKS = dict( ( CODES[m], m ) for m in range( 1, 16 ) )
+
+
+def complementMask( m ):
+    """swap the A and T bits and the C and G bits of mask m"""
+    return ( (m & A) << 3 ) | ( (m & C) << 1 ) | ( (m & G) >> 1 ) | ( (m & T) >> 3 )
+
+
+# complement of all codes, upper and lower case (X is an intron marker and
+# is kept as it is):
+_codes = CODES[1:] + 'X'
+_complements = ''.join( [ CODES[complementMask( MASKS[c] )] for c in CODES[1:] ] ) + 'X'
+COMPLEMENT = maketrans( _codes + _codes.lower(), _complements + _complements.lower() )
+VALID = frozenset( _codes + _codes.lower() )
+
+
+def reverseComplement( s ):
+    """return the reverse complement of the DNA string s, or None if s holds
+    anything but (ambiguous) nucleotides and X's"""
+    if not VALID.issuperset( s ):
+        return None
+    return s.translate( COMPLEMENT )[::-1]
+
+
+
+# Alignment columns are summarized in a mask with the nucleotide bits plus a
+# bit for X (intron) and N. As before, only the upper case A, C, G, T, X and N
+# symbols are taken into account.
+X, N = 16, 32
+
+COLUMNMASKS = np.zeros( 256, dtype=np.uint8 )
+for _c, _m in ( ('A', A), ('C', C), ('G', G), ('T', T), ('X', X), ('N', N) ):
+    COLUMNMASKS[ord(_c)] = _m
+
+
+def _columnCode( m ):
+    nucs = m & 15
+    if bin( nucs ).count( '1' ) in ( 2, 3 ):
+        return CODES[nucs]
+    if m & X:  # intron column with gaps in all other sequences
+        return 'intron-in-primer-error'
+    if m & N or nucs == 15: # 'N' is also used if all 4 nucleotides are observed
+        return 'N'
+    return 'no-mismatch-error' # no mismatch in this column OR all gaps
+
+# ambiguity code for each column mask:
+COLUMNCODES = [ _columnCode( m ) for m in range( 64 ) ]
+
+
+def columnMask( col ):
+    """return the column mask of col, a string or an array of byte values"""
+    if isinstance( col, str ):
+        col = np.frombuffer( col.encode( 'ascii' ), dtype=np.uint8 )
+    return int( np.bitwise_or.reduce( COLUMNMASKS[col] ) )
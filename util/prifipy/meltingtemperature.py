@@ -42,6 +42,83 @@ class Tm:
         self.logsaltf = logsalt * .368
         self.konstant2 = 16.6 * logsalt - 273.15
 
+        self.nncache = {} # dinucleotide -> (dH, dS)
+
+
+
+    def dinucleotide( self, bid ):
+        """return the (dH, dS) nearest-neighbour contribution of the
+        dinucleotide bid (ambiguity codes are averaged over all combinations).
+        Values are cached since there are only few different dinucleotides."""
+
+        try:
+            return self.nncache[bid]
+        except KeyError:
+            pass
+
+        seq = bid
+        j = 0
+
+        # handle ambiguity code characters
+        # ( see http://mbcr.bcm.tmc.edu/Guide/Sequences/iupac.html):
+        if 'U' in bid:
+            bid = bid.replace('U', 'T')
+
+        char = [seq[j], seq[j+1]]
+
+        for i in [0,1]:
+            if bid[i] == 'R':
+                char[i] = 'GA'
+            elif bid[i] == 'Y':
+                char[i] = 'TC'
+            elif bid[i] == 'M':
+                char[i] = 'AC'
+            elif bid[i] == 'K':
+                char[i] = 'TG'
+            elif bid[i] == 'S':
+                char[i] = 'GC'
+            elif bid[i] == 'W':
+                char[i] = 'TA'
+            elif bid[i] == 'H':
+                char[i] = 'TAC'
+            elif bid[i] == 'B':
+                char[i] = 'TCG'
+            elif bid[i] == 'V':
+                char[i] = 'GCA'
+            elif bid[i] == 'D':
+                char[i] = 'TGA'
+
+        if char != [0,0]:
+            comb = (len(char[0])*len(char[1]))
+            sumH = sumS = 0.0
+            for i in char[0]:
+                for j in char[1]:
+                    sumH += self.dH[ i+j ]
+                    sumS += self.dS[ i+j ]
+
+            sdh = sumH / comb
+            sds = sumS / comb
+        else:
+            sdh = self.dH[ seq[j:j+2] ]
+            sds = self.dS[ seq[j:j+2] ]
+
+        self.nncache[seq] = (sdh, sds)
+        return (sdh, sds)
+
+
+
+    def tmFromSums( self, dh, ds, n ):
+        """calculate the melting temperature of a sequence of length n from
+        its summed nearest-neighbour contributions dh, ds"""
+
+        # initiation values (for sugimoto the value is the same regardless
+        # of terminal base pair):
+
+        dh += self.dH['initGC']
+        ds += self.dS['initGC']
+
+        return dh / (ds + self.logsaltf*(n-1) + self.konstant1)+self.konstant2
+
 
 
     def tm( self, seq ):
@@ -50,61 +127,41 @@ class Tm:
 
         dh = ds = 0
         for j in range(len(seq)-1):
-
-            bid = seq[j:j+2]
-
-            # handle ambiguity code characters
-            # ( see http://mbcr.bcm.tmc.edu/Guide/Sequences/iupac.html):
-            if 'U' in bid:
-                bid = bid.replace('U', 'T')
-
-            char = [seq[j], seq[j+1]]
-            
-            for i in [0,1]:
-                if bid[i] == 'R':
-                    char[i] = 'GA'
-                elif bid[i] == 'Y':
-                    char[i] = 'TC'
-                elif bid[i] == 'M':
-                    char[i] = 'AC'
-                elif bid[i] == 'K':
-                    char[i] = 'TG'
-                elif bid[i] == 'S':
-                    char[i] = 'GC'
-                elif bid[i] == 'W':
-                    char[i] = 'TA'
-                elif bid[i] == 'H':
-                    char[i] = 'TAC'
-                elif bid[i] == 'B':
-                    char[i] = 'TCG'
-                elif bid[i] == 'V':
-                    char[i] = 'GCA'
-                elif bid[i] == 'D':
-                    char[i] = 'TGA'
-
-            if char != [0,0]:
-                comb = (len(char[0])*len(char[1]))
-                sumH = sumS = 0.0
-                for i in char[0]:
-                    for j in char[1]:
-                        sumH += self.dH[ i+j ]
-                        sumS += self.dS[ i+j ]
-
-                sdh = sumH / comb
-                sds = sumS / comb
-            else:
-                sdh = self.dH[ seq[j:j+2] ]
-                sds = self.dS[ seq[j:j+2] ]
-                
+            sdh, sds = self.dinucleotide( seq[j:j+2] )
             dh += sdh*1000.0
             ds += sds
 
+        return self.tmFromSums( dh, ds, len(seq) )
 
-        # initiation values (for sugimoto the value is the same regardless
-        # of terminal base pair):
-        
-        dh += self.dH['initGC']
-        ds += self.dS['initGC']
-        
-        return dh / (ds + self.logsaltf*(len(seq)-1) + self.konstant1)+self.konstant2
-        
+
+
+
+class TmWindows:
+    """melting temperatures of windows of a (gap-free) template sequence.
+
+    Tm(template[i:j]) is computed from running sums of the nearest-neighbour
+    contributions starting in i, so that scanning j upwards for a fixed start
+    i costs O(1) per window. The sums are accumulated in the same order as in
+    Tm.tm, so the results are identical."""
+
+    def __init__( self, TM, template ):
+        self.TM = TM
+        self.template = template
+        self.i = self.k = -1 # start index, index of next dinucleotide to add
+        self.dh = self.ds = 0
+
+    def tm( self, i, j ):
+        """return the melting temperature of template[i:j]"""
+
+        if i != self.i or j-1 < self.k:
+            # new start index (or shorter window): restart sums
+            self.i = self.k = i
+            self.dh = self.ds = 0
+
+        while self.k < j-1:
+            sdh, sds = self.TM.dinucleotide( self.template[self.k:self.k+2] )
+            self.dh += sdh*1000.0
+            self.ds += sds
+            self.k += 1
+
+        return self.TM.tmFromSums( self.dh, self.ds, j-i )
@@ -18,12 +18,14 @@
 ##
 
 from __future__ import division, print_function
-import ast
 import time
 from prifipy.alignment import *
-import prifipy.config as cf
+from prifipy.config import PrimerDesignConfig
 import sys
 from math import log10, atan
+import numpy as np
+from prifipy.meltingtemperature import TmWindows
+from prifipy.iupac import COLUMNCODES, columnMask
 from prifipy.reversecomplement import reverse_and_complement
 
 
@@ -89,6 +91,39 @@ class primer:
 
 
 
+class columncounts:
+    """cumulative column counts over the alignment, used to check a primer
+    candidate [i, j[ with a constant number of lookups instead of rescanning
+    its columns. For each property below, entry k of the list holds the number
+    of columns before column k with that property, i.e. the number of such
+    columns in [i, j[ is x[j]-x[i]."""
+
+    def __init__( self, cf, colsum, conservation ):
+        ndiff = np.array([c[0] for c in colsum], dtype=int)
+        ntotal = np.array([c[1] for c in colsum], dtype=int)
+        mism = ndiff > 1
+
+        def cumulative( a ):
+            return [0] + np.cumsum(a).tolist()
+
+        self.mmpos = np.flatnonzero(mism).tolist()  # mismatch column indices
+        self.mm = cumulative(mism)                   # mismatch columns
+        self.overmaxdiv = cumulative(mism & (ndiff > cf.MaxDiversityPerColumn))
+        self.maxdiv = cumulative(mism & (ndiff == cf.MaxDiversityPerColumn))
+        self.mt2n = cumulative(mism & (ndiff > 2) & (ndiff < cf.MaxDiversityPerColumn))
+        self.nucs = cumulative(ntotal)               # nucleotides in total
+        self.twoseqs = cumulative(ntotal == 2)       # columns with two seqs
+        self.twoseqsmm = cumulative((ntotal == 2) & mism)
+        self.unconserved = cumulative(np.array(conservation) == 0)
+
+    def mismatches( self, i, j ):
+        """list of mismatch column indices in [i, j["""
+        return self.mmpos[self.mm[i]:self.mm[j]]
+
+
+
+
+
 def doAlignment( file, verbose=0 ):
     """Perform clustalw alignment from the given file. The verbose parameter determines whether the command line given to clustalw is printed."""
 
@@ -167,53 +202,22 @@ def factorial( n ):
 
 def ambiguityCode( col ):
     """col is a string holding a mismatch column of the alignment. Based on the nucleotides in this column, return a one-letter ambiguity code."""
-    a = 'A' in col
-    c = 'C' in col
-    g = 'G' in col
-    t = 'T' in col
-    x = 'X' in col
-    n = 'N' in col
-
-    if a and c and not g and not t:
-        return 'M'
-    if a and g and not c and not t:
-        return 'R'
-    if a and t and not c and not g:
-        return 'W'
-    if c and g and not a and not t:
-        return 'S'
-    if c and t and not a and not g:
-        return 'Y'
-    if g and t and not c and not a:
-        return 'K'
-    if a and c and g and not t:
-        return 'V'
-    if a and c and t and not g:
-        return 'H'
-    if a and g and t and not c:
-        return 'D'
-    if c and g and t and not a:
-        return 'B'
-    if x:  # intron column with gaps in all other sequences
-        return 'intron-in-primer-error'
-    if n or (a and c and g and t): # 'N' is also used if all 4 nucleotides are observed
-        return 'N'
-
-    return 'no-mismatch-error' # no mismatch in this column OR all gaps
+    return COLUMNCODES[columnMask( col )]
 
 
 
 
 def insertAmbiguities( sq, s, e, dir, sm, colsum ):
-    """returns the sequence sq with inserted ambiguities (looked up in sm and colsum - i, j are the start, end indices of the string in the alignment), in rev.compl. form if dir==1"""
+    """returns the sequence sq with inserted ambiguities (looked up in the alignment sm and colsum - i, j are the start, end indices of the string in the alignment), in rev.compl. form if dir==1"""
 
     seq = sq
-    for i in range( s, e ):
-        if colsum[i][0] > 1:
-            # here's a mismatch
-            # deprecated:
-            #seq = ambiguityCode(sm.get_column(i)).join( [seq[:i-s], seq[i+1-s:]] )
-            seq = ambiguityCode(sm.alignment[:,i]).join( [seq[:i-s], seq[i+1-s:]] )
+    mismatches = [ i for i in range( s, e ) if colsum[i][0] > 1 ]
+    if mismatches:
+        # look up the ambiguity codes of all mismatch columns at once:
+        seq = list( seq )
+        for i, m in zip( mismatches, sm.columnmasks( mismatches ) ):
+            seq[i-s] = COLUMNCODES[m]
+        seq = ''.join( seq )
 
     if dir:
         return reverse_and_complement(seq)
@@ -222,8 +226,8 @@ def insertAmbiguities( sq, s, e, dir, sm, colsum ):
 
 
 def primer2string( p, dir, sm, colsum ):
-    """p is a primer, dir is the direction, 0 is forward, 1 is reverse. sm is a
-    summary of the alignment, colsum is a list of column summaries.
+    """p is a primer, dir is the direction, 0 is forward, 1 is reverse. sm is
+    the alignment (AlignmentMatrix), colsum is a list of column summaries.
     We return the primer in string format WITH AMBIGUITY CODES INSERTED.
     A primer is a tuple on this form:
         (score, s, e, i, j, part, Tmf, Tmr, mm )
@@ -294,7 +298,7 @@ def countATGCs( seq ):
 
 
 
-def scoreprimerpair( p1, p2, realindices, intronsbetweenprimers, explain=0 ):
+def scoreprimerpair( cf, p1, p2, realindices, intronsbetweenprimers, explain=0 ):
     """p1 is the forward primer, p2 is the reverse primer (needs to be reverse complemented). Thus p1 is assumed to reside to the left of p2 in the alignment.
     Return 3-tupel of (score, explanation for rewards, explanation for penalties) where the last two are strings and the first is a number. If the explain argument is 0, the explanations are empty strings."""
 
@@ -665,8 +669,209 @@ def scoreprimerpair( p1, p2, realindices, intronsbetweenprimers, explain=0 ):
 
 
 
-def scoreIndividualPrimer( p, colsum, conservation, explain=0 ):
+class primerpairscorer:
+    """scores a forward primer against all reverse primer candidates at once.
+
+    The candidates of all primer regions are kept in numpy arrays, sorted by
+    the (real) alignment index at which a product would end. For a forward
+    primer, only candidates within the MinProductLength/MaxProductLength
+    window are considered; all other pairs would be rejected by
+    scoreprimerpair anyway. The remaining pairs are scored as one block with
+    the same arithmetic as scoreprimerpair, so scores are identical."""
+
+    def __init__( self, cf, regionprimerlists, colsum, realindices ):
+        self.cf = cf
+        self.realindices = realindices
+        self.primers = []
+        region = []
+        for b in range( len( regionprimerlists ) ):
+            self.primers += regionprimerlists[b]
+            region += [b] * len( regionprimerlists[b] )
+        self.region = np.array(region, dtype=int)
+
+        # properties of candidates as reverse primers:
+        x = cf.Min3endPerfectMatches
+        self.rvok = np.array([ has_x_perfect_end_matches(x, 0, colsum, p.start, p.end) and \
+                               p.ATsInLeftTail != cf.TailLength for p in self.primers ], dtype=bool)
+        self.leftintronok = np.array([ p.nearestLeftIntron >= cf.MinPreIntronLength for p in self.primers ], dtype=bool)
+        self.tm = np.array([ p.tm for p in self.primers ], dtype=float)
+        self.score = np.array([ p.score for p in self.primers ], dtype=float)
+        self.rvscore = np.array([ p.rvscore for p in self.primers ], dtype=float)
+        self.noamb = np.array([ len(p.ambiguities) == 0 for p in self.primers ], dtype=bool)
+
+        # real index of product end, candidates sorted by it:
+        self.productend = np.array([ realindices[p.end-1] for p in self.primers ], dtype=int)
+        self.order = np.argsort( self.productend, kind='mergesort' )
+        self.sortedend = self.productend[self.order]
+
+
+    def candidates( self, p1, regionok, idx ):
+        """restrict candidate indices idx to reverse primers that may be
+        paired with forward primer p1 (regionok tells which regions may
+        hold the reverse primer)"""
+
+        cf = self.cf
+
+        ok = regionok[self.region[idx]] & self.rvok[idx]
+
+        # at least one primer must have a certain distance to the nearest intron:
+        if p1.nearestRightIntron < cf.MinPreIntronLength:
+            ok &= self.leftintronok[idx]
+
+        # primer melting temperatures have to be similar:
+        ok &= ~( np.abs( p1.tm - self.tm[idx] ) > cf.MaxPrimerPairTmDifference )
+
+        return idx[ok]
+
+
+    def countpairs( self, p1, regionok ):
+        """number of pairs with p1 as forward primer which are scored (i.e.
+        pass all checks before the product length check)"""
+        return len( self.candidates( p1, regionok, np.arange( len( self.primers ) ) ) )
+
+
+    def scorepairs( self, p1, regionok, minscore=None ):
+        """return a list of [score, p1, p2, pro, contra] for all positively
+        scored pairs with p1 as forward primer, in candidate order (the
+        entries are the same as scoreprimerpair would give without
+        explanations). If minscore is given, pairs scoring less than
+        minscore are left out."""
+
+        cf = self.cf
+
+        start = self.realindices[p1.start]
+        lo = np.searchsorted( self.sortedend, start + cf.MinProductLength, 'left' )
+        hi = np.searchsorted( self.sortedend, start + cf.MaxProductLength, 'right' )
+        idx = np.sort( self.candidates( p1, regionok, self.order[lo:hi] ) )
+        if len(idx) == 0:
+            return []
+
+        productlength = self.productend[idx] - start
+        tm2 = self.tm[idx]
+
+        # (see scoreprimerpair for the individual terms)
+        score = 0.0
+        score += p1.score
+        score = score + self.score[idx]
+        score = score + ( p1.fwscore + self.rvscore[idx] )
+
+        # both primers can't have too low Tm's:
+        pen = -( 9 * ( 2*cf.CriticalTm - p1.tm - tm2 ) )
+        if len(p1.ambiguities) == 0:
+            pen = np.where( self.noamb[idx], pen / 2, pen )
+        low = ( p1.tm < cf.CriticalTm ) & ( tm2 < cf.CriticalTm )
+        score = np.where( low, score + pen, score )
+
+        # penalize too short and too long products, reward longer products
+        # within the limits:
+        opl = cf.OptimalProductLength
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            short = ( -(opl[0] - productlength)/7 )
+            long = ( -(productlength - opl[3])/10 )
+            rising = cf.OptimalProductLengthReward * ( (productlength-opl[0])/float(opl[1] - opl[0]) )
+            falling = cf.OptimalProductLengthReward * ( (opl[3]-productlength)/float(opl[3] - opl[2]) )
+        pen = np.where( productlength <= opl[1], rising,
+                        np.where( productlength >= opl[2], falling, cf.OptimalProductLengthReward ) )
+        pen = np.where( productlength < opl[0], short, np.where( productlength > opl[3], long, pen ) )
+        score = score + pen
+
+        keep = score > 0
+        if minscore is not None:
+            keep &= score >= minscore
+        return [ [ float(sc), p1, self.primers[k], '\n', '' ] for k, sc in zip( idx[keep].tolist(), score[keep].tolist() ) ]
+
+
+
+
+
+
+
+
+class primerpairselector:
+    """collects scored primer pairs for the selection of the best
+    non-overlapping pairs, but keeps only the pairs that can still be
+    selected.
+
+    Pairs are selected greedily in order of decreasing score (pairs with
+    equal scores: the pair added last first). Now say C is a set of pairs
+    whose forward primers are pairwise disjoint, and likewise their reverse
+    primers. A single primer of length at most maxlen overlaps with at least
+    MatchOverlap bases with at most q = maxlen/MatchOverlap primers of C, so
+    a selected pair can be responsible for rejecting at most 2q pairs of C.
+    Hence, if C has (2q+1)*(suggestions-1)+1 pairs, the greedy selection has
+    found all suggestions once it has passed the last pair of C, no matter
+    which pairs with higher scores are added later. All pairs after it can
+    be dropped, and so can later pairs with lower scores."""
+
+    def __init__( self, cf, maxlen, capacity=4096 ):
+        q = max( 1, maxlen // cf.MatchOverlap )
+        self.certificate = max( 1, ( 2*q + 1 ) * ( cf.PrimerPairSuggestions - 1 ) + 1 )
+        self.capacity = capacity
+        self.entries = [] # ( score, number, pair )
+        self.added = 0
+        self.pruned = 0 # number of pairs dropped
+        self.cutoff = None # pairs with lower scores can be dropped
+
+
+    def add( self, pairs ):
+        """add list of [score, p1, p2, pro, contra] pairs"""
+        for pair in pairs:
+            if self.cutoff is not None and pair[0] < self.cutoff:
+                self.pruned += 1
+                continue
+            self.entries.append( ( pair[0], self.added, pair ) )
+            self.added += 1
+
+        if len( self.entries ) > self.capacity:
+            self.prune()
+
+
+    def prune( self ):
+        """drop all pairs ranked after the last pair of a full set C (see
+        above)"""
+        self.entries.sort( key=lambda e: ( e[0], e[1] ), reverse=True )
+
+        fws = []
+        rvs = []
+        for i, ( score, n, pair ) in enumerate( self.entries ):
+            p1, p2 = pair[1], pair[2]
+            if [ 1 for f in fws if p1.start < f.end and f.start < p1.end ] or \
+               [ 1 for r in rvs if p2.start < r.end and r.start < p2.end ]:
+                continue
+            fws.append( p1 )
+            rvs.append( p2 )
+            if len( fws ) == self.certificate:
+                self.pruned += len( self.entries ) - i - 1
+                del self.entries[i+1:]
+                self.cutoff = score
+                break
+
+        # don't prune again before the list has grown considerably:
+        self.capacity = max( self.capacity, 2 * len( self.entries ) )
+
+
+    def __len__( self ):
+        """total number of pairs added (including dropped pairs)"""
+        return len( self.entries ) + self.pruned
+
+
+    def sortedpairs( self ):
+        """return the kept pairs sorted by increasing score (i.e. overall
+        best pair is last). The kept pairs have the same positions from the
+        end as they would have if no pairs were dropped."""
+        self.entries.sort( key=lambda e: ( e[0], e[1] ) )
+        return [ e[2] for e in self.entries ]
+
+
+
+
+
+
+
+
+def scoreIndividualPrimer( cf, p, colsum, counts, explain=0 ):
     """p is a primer, give it its individual score which is used when scoring primer pairs.
+    counts holds the cumulative column counts of the alignment (see columncounts).
     If explain==1, add a textual explanation for the score to the primer."""
 
 
@@ -891,7 +1096,7 @@ def scoreIndividualPrimer( p, colsum, conservation, explain=0 ):
     # penalize primers not in highly conserved areas OR IN highly conserved
     # ares but based mostly on 2 seqs:
 
-    if 0 in conservation[p.start:p.end] or p.twoseqs >= .67*plen:
+    if counts.unconserved[p.end] > counts.unconserved[p.start] or p.twoseqs >= .67*plen:
         p.score += cf.NonConservationPenalty
         p.consscore = cf.NonConservationPenalty
 
@@ -1039,27 +1244,18 @@ def has_x_perfect_end_matches( x, end, colsum, i, j):
 
 
 
-def too_high_diversity_in_mismatches( colsum, i, j ):
-    """do the mismatches have too high a diversity?"""
+def too_high_diversity_in_mismatches( cf, counts, i, j ):
+    """do the mismatches have too high a diversity? counts holds the cumulative
+    column counts of the alignment (see columncounts)."""
 
     #global cf.MaxDiversityPerColumn, cf.MaxMismatchesWithMaxDiversity
 
-    colswithmaxdiversity = 0
-    colswithmt2n = 0 # more than 2, less than max
-    mm = 0
-
-    for q in xrange(i, j):
-
-        if colsum[q][0] > 1:
-            # mismatch!
+    if counts.overmaxdiv[j] > counts.overmaxdiv[i]:
+        return 1
 
-            mm += 1
-            if colsum[q][0] > cf.MaxDiversityPerColumn:
-                return 1
-            elif colsum[q][0] == cf.MaxDiversityPerColumn:
-                colswithmaxdiversity += 1
-            elif colsum[q][0] > 2:
-                colswithmt2n += 1
+    colswithmaxdiversity = counts.maxdiv[j] - counts.maxdiv[i]
+    colswithmt2n = counts.mt2n[j] - counts.mt2n[i] # more than 2, less than max
+    mm = counts.mm[j] - counts.mm[i]
 
     if colswithmaxdiversity > cf.MaxMismatchesWithMaxDiversity:
         return 1
@@ -1075,27 +1271,15 @@ def too_high_diversity_in_mismatches( colsum, i, j ):
 
 
 
-def too_many_mismatches( colsum, i, j, tm ):
+def too_many_mismatches( cf, counts, i, j, tm ):
     """too many mismatches in this primer? if melting temperature is close to the minimal value, we need to have 0 mismatches.
-    Return (a, b) where a is 0 or 1 (false or true as to the question 'too many mismatches..') and b is the number of mismatches."""
+    counts holds the cumulative column counts of the alignment (see columncounts).
+    Return (a, b) where a is 0 or 1 (false or true as to the question 'too many mismatches..') and b is the list of mismatch positions."""
 
     #global cf.MaxMismatches
     #global cf.MinTmWithMismatchesAllowed
 
-    mm = []       # list of mismatch column indices
-    # twoseqs = 1   # yes, we think we have only 2 seqs in this alignment part
-
-    for q in xrange(i, j):
-
-        if colsum[q][0] > 1:
-            #if q>i:
-            #    if colsum[q-1][0] > 1:
-            #        return (1, []) # two consecutive mismatches
-            mm.append( q )
-
-        # if colsum[q][1] > 2:
-        #    twoseqs = 0
-
+    mm = counts.mismatches( i, j ) # list of mismatch column indices
 
     if len(mm) > cf.MaxMismatches:
         return (1, mm)
@@ -1112,7 +1296,7 @@ def too_many_mismatches( colsum, i, j, tm ):
 
 
 
-def find_primer_regions_old( a ):
+def find_primer_regions_old( cf, a ):
     """a is a list of columnscores"""
 
     # with column scores 1, -2, -infinity, this function delimits regions
@@ -1145,7 +1329,7 @@ def find_primer_regions_old( a ):
 
 
 
-def find_primer_regions( a ):
+def find_primer_regions( cf, a ):
    """a is a list of columnscores. Go through a, locate negative entries (not
    -infinity), check whether a window of (MinPrimerLength) can be placed
    around each which holds in total at most (MaxMismatches) mismatches. If not,
@@ -1231,23 +1415,28 @@ def find_primer_regions( a ):
 # --------------------------------------------------------------------------------
 
 
-def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
-    """verbose is 1 if we want comments printed, 0 otherwise"""
+def findprimers( verbose, allseq, summary, l, settings=(), logfile=sys.stderr):
+    """verbose is 1 if we want comments printed, 0 otherwise. allseq is the
+    alignment, either an AlignmentMatrix or a list of Biopython records
+    (summary and l are not needed any more and may be None). settings is a
+    PrimerDesignConfig or a list of (parameter name, value string) pairs to
+    create one from."""
 
 
     # apply external settings
-    for key, val in settings:
-        old_val = getattr(cf, key)
-        new_val = ast.literal_eval(val)
-        setattr(cf, key, new_val)
-        #print("%s:\t%s (was: %s)" % (key, getattr(prifipy.config, key), old_val), file=logfile)
+    if isinstance(settings, PrimerDesignConfig):
+        cf = settings
+    else:
+        cf = PrimerDesignConfig( settings )
 
 
 
-    # calculate summary information for all columns and
-    # create vector of columnscores from score matrix:
-    mpsvector = []
-    colsum = []
+    # the alignment may be given as a list of Biopython records or as an
+    # AlignmentMatrix:
+    if not isinstance(allseq, AlignmentMatrix):
+        allseq = AlignmentMatrix(allseq)
+    l = allseq.get_alignment_length()
+
     # list of intron start, end indices (BOTH inclusive!), initialized
     # with dummy value:
     intronindices = [ (-2, -2) ]
@@ -1258,17 +1447,14 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
     realindices = []
     totalintronlength = 0
     lastintronlength = 0
-    lenallseq = len(allseq)
 
-    for i in xrange(l):
-		# deprecated:
-        #column = summary.get_column(i)
-        column = summary.alignment[:,i]
+    if cf.INTRONS == 'yes':
+        introncolumns = allseq.intron_columns()
 
-        if cf.INTRONS == 'yes':
+        for i in xrange(l):
 
             # remember last index only of each intron:
-            if ('X' in column or 'x' in column):
+            if introncolumns[i]:
 
                 realindices.append(i+totalintronlength) # a dummy value really
                 lastintronlength += 1
@@ -1291,13 +1477,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                     # X'es. In that case, find the longest series of X'es in the
                     # same sequence
 
-                    lil = 0
-                    for tse in range(lenallseq):
-                        # deprecated:
-                        #xs = allseq[tse].seq.data[i-lastintronlength:i].count('X')
-                        xs = allseq[tse].seq[i-lastintronlength:i].count('X')
-                        if xs > lil:
-                            lil = xs
+                    lil = int(allseq.count('X', i-lastintronlength, i).max())
 
                     if lil > 6:
                         raise(ValueError, "Weird marker length at index %d: %d"%(lil, i-lastintronlength))
@@ -1309,17 +1489,21 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                     totalintronlength += trull-lastintronlength # don't count marker length
                     lastintronlength = 0
                 realindices.append(i+totalintronlength)
-        else:
-            # we don't use special intron markers
-            realindices.append(i) # same as regular index
-
-        colsum.append( columnsummary( column ) )
+    else:
+        # we don't use special intron markers
+        realindices = list(xrange(l)) # same as regular index
 
-        if colsum[-1][1]>23: # this is out of scope of the score matrix
-            mpsvector.append( cf.scorematrix[colsum[-1][0]][23] )
-        else:
-            mpsvector.append( cf.scorematrix[colsum[-1][0]][colsum[-1][1]] )
+    # calculate summary information for all columns and
+    # create vector of columnscores from score matrix
+    # (number of nucleotides above 23 is out of scope of the score matrix):
+    ndiff, ntotal = allseq.columnsummaries()
+    colsum = list(zip(ndiff.tolist(), ntotal.tolist()))
+    mpsvector = np.asarray(cf.scorematrix)[ndiff, np.minimum(ntotal, 23)].tolist()
 
+    # gap-free primer template, see below:
+    template = allseq.template()
+    # melting temperatures of template windows:
+    tmwindows = TmWindows( cf.TM, template )
 
 
 
@@ -1373,6 +1557,9 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
     # now conservation is a list of 0's and 1's: a 1 in index i means that column
     # i resides in a window of sufficient conservation, a 0 that it doesn't.
 
+    # cumulative column counts for checking primer candidates:
+    counts = columncounts( cf, colsum, conservation )
+
 
 
 
@@ -1395,7 +1582,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
     # find the primer regions:
 
-    primerregions = find_primer_regions( mpsvector )
+    primerregions = find_primer_regions( cf, mpsvector )
     if verbose:
         if cf.INTRONS == 'yes':
             print(' found introns:', intronindices, file=logfile)
@@ -1438,30 +1625,9 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                 # no gaps and use that as primer (candidate):
 
 
-                ppp = []
-                for q in xrange(i, j):
-                    # deprecated:
-                    #if allseq[0].seq.data[q] != '-':
-                    if allseq[0].seq[q] != '-':
-                        # deprecated:
-                        #ppp.append(allseq[0].seq.data[q])
-                        ppp.append(allseq[0].seq[q])
-                    else:
-                        # pick symbol from one of the other seqs:
-                        for rl in xrange(1, lenallseq):
-                            # deprecated:
-                            #if allseq[rl].seq.data[q] != '-':
-                            if allseq[rl].seq[q] != '-':
-                                # deprecated:
-                                #ppp.append(allseq[rl].seq.data[q])
-                                ppp.append(allseq[rl].seq[q])
-                                break # found non-gap symbol
-                        else:
-                            # all-gap column! shouldn't ever happen,
-                            # but to avoid crash insert random symbol:
-                            ppp.append('C')
-
-                part = "".join(ppp)
+                # (in all-gap columns, the symbol is taken from one of the
+                # other seqs; see AlignmentMatrix.template())
+                part = template[i:j]
 
 
                 ##
@@ -1507,7 +1673,8 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                 # melting temp. le Novere/sugimoto (see config.py):
 
 
-                Tm = cf.TM.tm( part )
+                # (same as cf.TM.tm( part ), but incremental in j)
+                Tm = tmwindows.tm( i, j )
 
 
 
@@ -1523,7 +1690,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
 
 
-                (tmm, mm) = too_many_mismatches( colsum, i, j, Tm )
+                (tmm, mm) = too_many_mismatches( cf, counts, i, j, Tm )
                 if tmm:
                     # print "too many mismatches (%d, %d), tm=%f:"%(i, j, Tm)
                     # printslice(allseq, i, j)
@@ -1548,7 +1715,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                     continue
 
 
-                if too_high_diversity_in_mismatches( colsum, i, j ):
+                if too_high_diversity_in_mismatches( cf, counts, i, j ):
                     highdiv += 1
                     continue
 
@@ -1561,15 +1728,11 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
 
                 # find average number of sequences in the primer's alignment part:
-                ii = 0.0
-                twoseqs = 0 # number of columns with only two sequences represented
-                mmt = 0     # number of mismatches in cols with only two seqs
-                for q in xrange(i, j):
-                    ii += colsum[q][1]
-                    if colsum[q][1] == 2:
-                        twoseqs += 1
-                        if colsum[q][0] > 1:
-                            mmt += 1
+                ii = float(counts.nucs[j] - counts.nucs[i])
+                # number of columns with only two sequences represented:
+                twoseqs = counts.twoseqs[j] - counts.twoseqs[i]
+                # number of mismatches in cols with only two seqs:
+                mmt = counts.twoseqsmm[j] - counts.twoseqsmm[i]
 
                 sia = ii/partlen # avg. number of seqs in alignment per column
 
@@ -1587,7 +1750,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
                 # if at least 2/3 of the primer is based on only two sequences,
                 # it must be in a highly conserved region, and the 2-seq part
                 # can have at most 2 mismatches ( and there may be only 3 in total):
-                if twoseqs >= .67*partlen and (0 in conservation[i:j] or mmt > 2 or lenmm > 3):
+                if twoseqs >= .67*partlen and (counts.unconserved[j] > counts.unconserved[i] or mmt > 2 or lenmm > 3):
                     continue
 
                 score = None # scoreprimer( part, colsum, i, j, len(mm) )
@@ -1627,7 +1790,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
                 # create primer object:
                 pp = primer(s, e, i, j, part, Tm, mm, nearestintronl, nearestintronr, sia, ATr, ATl, twoseqs )
-                scoreIndividualPrimer( pp, colsum, conservation )
+                scoreIndividualPrimer( cf, pp, colsum, counts )
                 #print i, j, pp.score
 
                 # if this candidate overlaps with another candidate already found
@@ -1785,7 +1948,6 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
     if 0 and verbose:
         print(' ---------------------------\n checking all primer pairs..', file=logfile)
-    primerpairs = []
 
     # stats variables:
     tmth = sameregion= difftm = nointrons = x6p2 = noID = IDtoofar = ne3m = tsmt = tmm = spi = pl = oot = 0
@@ -1799,10 +1961,48 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
     # now pair all with all:
 
+    pairscorer = primerpairscorer( cf, regionprimerlists, colsum, realindices )
 
+    maxlen = max( [ p.end - p.start for primers in regionprimerlists for p in primers ] + [ 1 ] )
+    selector = primerpairselector( cf, maxlen )
 
     for a in range( len( regionprimerlists ) ):
 
+        # if we're looking at sequences with no intron symbols, we have
+        # to pair primers from the same region, otherwise we don't:
+        if cf.INTRONS == 'no':
+            sreg = a
+        else:
+            sreg = a+1
+
+        # which regions may hold the reverse primer?
+        regionok = np.zeros( len( regionprimerlists ), dtype=bool )
+        for b in range( sreg, len( regionprimerlists ) ):
+
+            intronsbetweenregions, x6 = IntronsBetweenRegions( intronindices, regionprimerlists[a][0].regionstart, regionprimerlists[b][0].regionstart )
+
+            # (these are set to [] and 0 if cf.INTRONS == 'yes' is 0)
+
+
+
+            if cf.INTRONS == 'yes':
+                # there has to be at least one intron between the regions:
+                if len( intronsbetweenregions ) == 0:
+                    # no introns, don't consider the a region together with
+                    # the b region.
+                    continue
+
+            # primers can't be too far from each other:
+            # if there is an XXXXXX intron between the primers,
+            # there can be at most
+            # two introns in total between them.
+
+            if x6 > 0 and len( intronsbetweenregions ) > 2:
+                continue
+
+            regionok[b] = True
+
+
         for p1 in regionprimerlists[a]:
 
             # primer temperature can't be too small or large:
@@ -1824,165 +2024,15 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
             if p1.ATsInRightTail == cf.TailLength:
                 continue # AT tail
 
-            # p1 is okay as forward primer, find a partner from another region:
-
-            # if we're looking at sequences with no intron symbols, we have
-            # to pair primers from the same region, otherwise we don't:
-            if cf.INTRONS == 'no':
-                sreg = a
-            else:
-                sreg = a+1
-
-            for b in range( sreg, len( regionprimerlists ) ):
-
-                intronsbetweenregions, x6 = IntronsBetweenRegions( intronindices, regionprimerlists[a][0].regionstart, regionprimerlists[b][0].regionstart )
-
-                # (these are set to [] and 0 if cf.INTRONS == 'yes' is 0)
-
-
-
-                if cf.INTRONS == 'yes':
-                    # there has to be at least one intron between the regions:
-                    if len( intronsbetweenregions ) == 0:
-                        # no introns, don't consider the a region together with
-                        # the b region.
-                        continue
-
-                # primers can't be too far from each other:
-                # if there is an XXXXXX intron between the primers,
-                # there can be at most
-                # two introns in total between them.
-
-                if x6 > 0 and len( intronsbetweenregions ) > 2:
-                    continue
-
-
-
-
-                # okay, go on to score all pairs from these regions:
-
-                for p2 in regionprimerlists[b]:
-
-                    # p1 is fw primer, p2 is rv primer
-
-
-                    # We have to have at least X perfect matches in the 3' end
-                    # (i.e. left end of right primer):
-
-                    # if mmf == MaxMismatches:
-                    #    x = Min3endPerfectMatchesIfPrimerHasMaxMismatches
-                    # else:
-                    x = cf.Min3endPerfectMatches
-
-                    if not has_x_perfect_end_matches(x, 0, colsum, p2.start, p2.end):
-                        continue
+            # p1 is okay as forward primer, find partners from the allowed
+            # regions (the reverse primer checks, i.e. 3'-end matches, AT tail,
+            # intron distance and Tm difference, as well as the product
+            # length check and the scoring are done by the pair scorer):
 
+            selector.add( pairscorer.scorepairs( p1, regionok, selector.cutoff ) )
 
-
-
-
-                    # AT tail in 3'-end:
-                    if p2.ATsInLeftTail == cf.TailLength:
-                        continue
-
-
-                    # at least one primer must have a certain distance to
-                    # the nearest intron:
-                    if p1.nearestRightIntron < cf.MinPreIntronLength and p2.nearestLeftIntron < cf.MinPreIntronLength:
-                        continue
-                    # both are set right if cf.INTRONS == 'yes' is 0
-
-
-
-                    # CHECKED ABOVE:
-                    # primer temperature can't be too small:
-                    #if p2.tm < cf.MinTm or p2.tm > cf.SuggestedMaxTm:
-                    #    print '\nSHOULD NEVER HAPPEN I THINK'
-                    #    # jeg tror nok Tm er ens i begge retninger, og dem
-                    #    # der er for lave i begge retninger er renset ud tidligere
-                    #    continue
-
-
-                    # primer melting temperatures have to be similar:
-                    if abs( p1.tm - p2.tm ) > cf.MaxPrimerPairTmDifference:
-                        continue
-
-
-
-                    # find score of primer pair (obtain no textual report)
-                    score, pro, contra = scoreprimerpair( p1,p2, realindices, intronsbetweenregions)
-
-                    pairsscored += 1
-
-                    # debugging:
-                    # for checking a particular primer pair:
-                    if 0:
-
-
-
-                        if p1.start==456 and p1.end == 487 and \
-                               p2.start==703 and p2.end==727:
-
-
-                        #checkstring1 =insertAmbiguities( p1.seq,p1.start,p1.end,0,summary, colsum)
-                        #checkstring2 =insertAmbiguities( p2.seq,p2.start,p2.end,1,summary, colsum)
-                        #if checkstring1 == 'GCACYATAATTTATTTGCTTGGGCARCAGCT'\
-                        #       and checkstring2 == 'TGGAGCACCACTTTGCTTAATAGC':
-
-                            # get explanations:
-                            scoreIndividualPrimer( p1, colsum, conservation, 1 )
-                            scoreIndividualPrimer( p2, colsum, conservation, 1 )
-                            score1,pro1,contra1=scoreprimerpair( p1,p2, realindices, intronsbetweenregions, 1)
-
-                            print('\nCHECKED PRIMER PAIR:', file=logfile)
-                            #print p1
-                            #print p2
-
-
-                            print('score',score1, file=logfile)
-                            print(primer2string( p1, 0, summary, colsum ), file=logfile)
-                            print(primer2string( p2, 1, summary, colsum ), file=logfile)
-                            print(pro1, contra1)
-
-                            # printslice(allseq, 1447, 1478)
-
-
-
-
-
-                    if score > 0:
-                        primerpairs.append( [score, p1, p2, pro, contra] )
-
-                        # elif score == -1:
-                        #     sameregion += 1
-                    elif score == -2:
-                        difftm += 1
-                    elif score == -3:
-                        nointrons += 1
-                    elif score == -4:
-                        x6p2 += 1
-                    elif score == -5:
-                        noID += 1
-                    elif score == -6:
-                        IDtoofar += 1
-                    elif score == -7:
-                        ne3m += 1
-                    elif score == -8:
-                        tsmt += 1
-                    elif score == -9:
-                        tmm += 1
-                    elif score == -10:
-                        tmth += 1
-                    elif score == -11:
-                        spi += 1
-                    elif score == -12:
-                        pl += 1
-                    elif score == -13:
-                        oot += 1
-
-                        # if score <-1:
-                        #    print primer2string(p1, 0)
-                        #    print primer2string(p2, 1),' score %d\n'%score
+            if verbose:
+                pairsscored += pairscorer.countpairs( p1, regionok )
 
     tid2 = time.time()
     if verbose:
@@ -2018,7 +2068,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
         if oot>0:
             print(" ID exons too short & too far: %6d"%pl, file=logfile)
 
-        print(" Possibly valid pairs        : %6d"%len(primerpairs), file=logfile)
+        print(" Possibly valid pairs        : %6d"%len(selector), file=logfile)
         print('                              ------', file=logfile)
 
     if verbose:
@@ -2026,12 +2076,12 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
 
 
-    if len(primerpairs) == 0:
+    if len(selector) == 0:
         return None
 
     # the score has to be the first entry of the primer pair tupel
-    #primerpairs.sort()
-    primerpairs = sorted(primerpairs, key=lambda pp: pp[0])
+    # (pairs dropped by the selector all come before the kept ones):
+    primerpairs = selector.sortedpairs()
 
 
 
@@ -2046,9 +2096,9 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
     while 1:
         if rep == cf.PrimerPairSuggestions: # found enough
             break
-        s, p1, p2, pro, contra = primerpairs[count]
-        if -count == len(primerpairs):
+        if -count == len(selector):
             break # didn't find PrimerPairSuggestions different pairs..
+        s, p1, p2, pro, contra = primerpairs[count]
 
         seenalready = 0
         sawleft = sawright = 0
@@ -2105,9 +2155,9 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
         # now score the pairs again but obtain the explanations:
         intronsbetweenprimers, x6 =IntronsBetweenRegions(intronindices, p1.regionstart, p2.regionstart)
-        scoreIndividualPrimer( p1, colsum, conservation, 1 )
-        scoreIndividualPrimer( p2, colsum, conservation, 1 )
-        s,pro,contra=scoreprimerpair( p1,p2,realindices,intronsbetweenprimers, 1)
+        scoreIndividualPrimer( cf, p1, colsum, counts, 1 )
+        scoreIndividualPrimer( cf, p2, colsum, counts, 1 )
+        s,pro,contra=scoreprimerpair( cf, p1,p2,realindices,intronsbetweenprimers, 1)
 
         if s != score:
             print('something is WRONG %f %f\n\n'%(s, score), file=logfile)
@@ -2116,8 +2166,8 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
 
 
-        q1 = insertAmbiguities( p1.seq, p1.start, p1.end, 0, summary, colsum)
-        q2 = insertAmbiguities( p2.seq, p2.start, p2.end, 1, summary, colsum)
+        q1 = insertAmbiguities( p1.seq, p1.start, p1.end, 0, allseq, colsum)
+        q2 = insertAmbiguities( p2.seq, p2.start, p2.end, 1, allseq, colsum)
 
 
         # return the explanations and indices too (indices are needed by the gui):
@@ -2132,9 +2182,9 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
         if verbose:
             print('-'*50, file=logfile)
             print('score %.1f (rank %d)'%(s, -count), file=logfile)
-            print(primer2string( p1, 0, summary, colsum ), file=logfile)
+            print(primer2string( p1, 0, allseq, colsum ), file=logfile)
             # print p2.start, p2.end, reverse_and_complement(p2.seq), p2.tm, p2.tm
-            print(primer2string( p2, 1, summary, colsum ), file=logfile)
+            print(primer2string( p2, 1, allseq, colsum ), file=logfile)
 
             print(pro, contra, file=logfile)
 
@@ -2144,7 +2194,7 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
 
             #             print '-'*50
             #             print 'score %d'%(s)
-            #             print primer2string( p1, 0, summary, colsum )
+            #             print primer2string( p1, 0, allseq, colsum )
             #
             #             print primer2string( p2, 1, summary, colsum  )
 
@@ -2153,8 +2203,8 @@ def findprimers( verbose, allseq, summary, l, settings, logfile=sys.stderr):
             # print 'Best pair (score %d):\n'%primerpairs[-1][0],primerpairs[-1][3], primerpairs[-1][4]
 
     # s, p1, p2, pro, contra = primerpairs[-1]
-    # q1 = primer2string( p1, 0, summary, colsum ).split()[-1]
-    # q2 = primer2string( p2, 1, summary, colsum ).split()[-2]
+    # q1 = primer2string( p1, 0, allseq, colsum ).split()[-1]
+    # q2 = primer2string( p2, 1, allseq, colsum ).split()[-2]
     # use a more convenient function:
     # q1 = insertAmbiguities( p1.seq, p1.start, p1.end, 0, summary, colsum)
     # q2 = insertAmbiguities( p2.seq, p2.start, p2.end, 1, summary, colsum)
@@ -2205,7 +2255,8 @@ def test( tfil, start = '0'):
         allseq, summary, l = doAlignment( i, 0 )
 
 
-        primerpairs = findprimers( 0, allseq, summary, l ) # get list of primer pair suggestions
+        cf = PrimerDesignConfig()
+        primerpairs = findprimers( 0, allseq, summary, l, cf ) # get list of primer pair suggestions
 
         nomatch = 'Disagreement'
         nomatchstring = []
@@ -2347,11 +2398,12 @@ if __name__ == '__main__':
         sys.exit(0)
 
     # check input for intron hints
+    cf = PrimerDesignConfig()
     cf.INTRONS = 'yes' if hasIntrons( sys.argv[1] ) else 'no'
 
     allseq, summary, l = doAlignment( sys.argv[1], 1 )
 
-    primerpairs = findprimers( 1, allseq, summary, l )
+    primerpairs = findprimers( 1, allseq, summary, l, cf )
 
 
 